@@ -0,0 +1,410 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import asyncio
+import importlib.util
+import json
+import os
+import time
+
+import httpx
+import requests
+
+import JsonBackend
+from CyodaSession import (
+    APPLICATION_JSON,
+    DEFAULT_BATCH_BYTES,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_MAX_IN_FLIGHT,
+    DEFAULT_POOL_SIZE,
+    DEFAULT_SEARCH_TIMEOUT,
+    WIPE_ALWAYS,
+    WIPE_IF_NEEDED,
+    WIPE_NEVER,
+    BatchFailure,
+    BulkCreateResult,
+    PollingStrategy,
+    _batch_records,
+    _response_json,
+    read_password,
+)
+from ModelSchema import SchemaChangeError, export_schema, infer_file_schema, schema_additions, schema_fingerprint
+
+DEFAULT_MAX_CONCURRENCY = 100
+
+
+class AsyncCyodaSession:
+    def __init__(
+            self,
+            api_url,
+            username='demo.user',
+            password_file_path='/Users/paul/.cyoda/demo.passwd',
+            password_env_value='DEMO_USER_PASSWD',
+            pool_maxsize=DEFAULT_POOL_SIZE,
+            max_concurrency=DEFAULT_MAX_CONCURRENCY,
+            http2=None,
+            timeout=None
+    ):
+        self.api_url = api_url
+        self.login_endpoint = f"{api_url}/auth/login"
+        self.token_endpoint = f"{api_url}/auth/token"
+        self.username = username
+        self.password = os.getenv(password_env_value, None)
+        self.password_file_path = password_file_path
+
+        # HTTP/2 multiplexes all requests over a single connection where the server supports it,
+        # it is used whenever the optional h2 package is installed unless switched off explicitly
+        if http2 is None:
+            http2 = importlib.util.find_spec('h2') is not None
+
+        self.http = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize),
+            timeout=timeout,
+            headers={'Content-Type': APPLICATION_JSON}
+        )
+        self.concurrency = asyncio.Semaphore(max_concurrency)
+        self.access_token = ""
+        self.polling = PollingStrategy()
+
+        if not self.password:
+            self.password = read_password(self.password_file_path)
+
+        self.credentials = {
+            'username': self.username,
+            'password': self.password
+        }
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        await self.http.aclose()
+
+    @property
+    def access_token(self):
+        return self._access_token
+
+    @access_token.setter
+    def access_token(self, token):
+        self._access_token = token
+        if token:
+            self.http.headers['Authorization'] = f'Bearer {token}'
+        else:
+            self.http.headers.pop('Authorization', None)
+
+    async def _request(self, method, url, **kwargs):
+        async with self.concurrency:
+            return await self.http.request(method, url, **kwargs)
+
+    async def connect(self):
+        headers = {
+            'X-Requested-With': 'XMLHttpRequest'
+        }
+        payload = JsonBackend.dumps(self.credentials)
+        response = await self._request('POST', self.login_endpoint, headers=headers, content=payload,
+                                       auth=_without_authorization)
+
+        if response.status_code == 200:
+            return _response_json(response).get('refreshToken')
+        else:
+            raise requests.HTTPError(f"Login failed: {response.status_code} {response.text}")
+
+    async def get_access_token(self, refresh_token):
+        headers = {
+            'Authorization': f'Bearer {refresh_token}'
+        }
+        response = await self._request('GET', self.token_endpoint, headers=headers)
+
+        if response.status_code == 200:
+            token_data = _response_json(response)
+            self.access_token = token_data.get('token')
+            return self.access_token
+        else:
+            raise requests.HTTPError(f"Token refresh failed: {response.status_code} {response.text}")
+
+    async def model_exists(self, model_name, model_version):
+        export_model_url = f"{self.api_url}/treeNode/model/export/SIMPLE_VIEW/{model_name}/{model_version}"
+        response = await self._request('GET', export_model_url)
+        return response.status_code == 200
+
+    async def get_model(self, model_name, model_version):
+        export_model_url = f"{self.api_url}/treeNode/model/export/SIMPLE_VIEW/{model_name}/{model_version}"
+        response = await self._request('GET', export_model_url)
+        if response.status_code == 200:
+            return _response_json(response)
+        else:
+            raise requests.HTTPError(f"Getting the model failed: {response.status_code} {response.text}")
+
+    async def get_model_state(self, model_name, model_version):
+        return (await self.get_model(model_name, model_version)).get('currentState')
+
+    async def unlock_model(self, model_name, model_version):
+        unlock_model_url = f"{self.api_url}/treeNode/model/{model_name}/{model_version}/unlock"
+        response = await self._request('PUT', unlock_model_url)
+        if response.status_code == 200:
+            print('Model unlocked')
+        else:
+            raise requests.HTTPError(f"Unlock failed: {response.status_code} {response.text}")
+
+    async def lock_model(self, model_name, model_version):
+        lock_model_url = f"{self.api_url}/treeNode/model/{model_name}/{model_version}/lock"
+        response = await self._request('PUT', lock_model_url)
+        if response.status_code == 200:
+            print('Model locked')
+        else:
+            raise requests.HTTPError(f"Lock failed: {response.status_code} {response.text}")
+
+    async def delete_model(self, model_name, model_version):
+        model_url = f"{self.api_url}/treeNode/model/{model_name}/{model_version}"
+        response = await self._request('DELETE', model_url)
+        if response.status_code == 200:
+            print('Model deleted')
+        else:
+            raise requests.HTTPError(f"Deletion of the model failed: {response.status_code} {response.text}")
+
+    async def delete_all_entities(self, model_name, model_version):
+        delete_entities_url = f"{self.api_url}/entity/TREE/{model_name}/{model_version}"
+        params = {
+            'pageSize': '1000',
+            'transactionSize': '1000'
+        }
+        response = await self._request('DELETE', delete_entities_url, params=params)
+
+        if response.status_code == 200:
+            return self.calculate_total_entities_removed(_response_json(response))
+        else:
+            raise requests.HTTPError(f"Deletion failed: {response.status_code} {response.text}")
+
+    def calculate_total_entities_removed(self, data):
+        total_entities_removed = 0
+        for entry in data:
+            total_entities_removed += entry['deleteResult']['numberOfEntititesRemoved']
+        return total_entities_removed
+
+    async def reset_model(self, model_name, model_version, file_path, wipe=WIPE_NEVER):
+        # Same as CyodaSession.reset_model: the delete-everything cycle only runs when wipe allows it
+        # ('if_needed') or asks for it ('always'). Returns 'created', 'unchanged', 'extended' or 'wiped'.
+        print(f"Resetting model '{model_name}' version {model_version}")
+        if wipe not in (WIPE_NEVER, WIPE_IF_NEEDED, WIPE_ALWAYS):
+            raise ValueError(f"wipe must be one of '{WIPE_NEVER}', '{WIPE_IF_NEEDED}' or '{WIPE_ALWAYS}', not {wipe}")
+
+        if wipe == WIPE_ALWAYS:
+            await self._wipe_model(model_name, model_version)
+            await self._derive_and_lock(model_name, model_version, file_path)
+            return 'wiped'
+
+        if not await self.model_exists(model_name, model_version):
+            print(f"Model {model_name} {model_version} doesn't exist. Nothing to delete.")
+            await self._derive_and_lock(model_name, model_version, file_path)
+            return 'created'
+
+        # Reading the sample blocks, so it runs off the event loop
+        sample_schema = await asyncio.to_thread(infer_file_schema, file_path)
+        model = await self.get_model(model_name, model_version)
+        model_schema = export_schema(model)
+        additions = schema_additions(sample_schema, model_schema)
+        if not additions:
+            print(f"Model '{model_name}' version {model_version} already covers the sample "
+                  f"(schema {schema_fingerprint(model_schema)[:12]}), nothing to reset")
+            if model.get('currentState') != 'LOCKED':
+                await self.lock_model(model_name, model_version)
+            return 'unchanged'
+
+        print(f"The sample adds {len(additions)} paths to the model: {', '.join(sorted(additions))}")
+        try:
+            if await self.get_model_state(model_name, model_version) == 'LOCKED':
+                await self.unlock_model(model_name, model_version)
+            await self._derive_and_lock(model_name, model_version, file_path)
+            return 'extended'
+        except requests.HTTPError as e:
+            if wipe != WIPE_IF_NEEDED:
+                if await self.get_model_state(model_name, model_version) != 'LOCKED':
+                    await self.lock_model(model_name, model_version)
+                raise SchemaChangeError(
+                    f"Model '{model_name}' version {model_version} can not be extended in place: {e}. "
+                    f"Pass wipe='{WIPE_IF_NEEDED}' to delete all its entities and derive it again") from e
+            print(f"Extending the model in place failed, wiping it: {e}")
+
+        await self._wipe_model(model_name, model_version)
+        await self._derive_and_lock(model_name, model_version, file_path)
+        return 'wiped'
+
+    async def _wipe_model(self, model_name, model_version):
+        if await self.model_exists(model_name, model_version):
+            print(f"Deleting all data for model '{model_name}' version {model_version}")
+            total_entities_deleted = await self.delete_all_entities(model_name, model_version)
+            print(f"Total entities deleted: {total_entities_deleted}")
+
+            if await self.get_model_state(model_name, model_version) == 'LOCKED':
+                await self.unlock_model(model_name, model_version)
+            await self.delete_model(model_name, model_version)
+        else:
+            print(f"Model {model_name} {model_version} doesn't exist. Nothing to delete.")
+
+    async def _derive_and_lock(self, model_name, model_version, file_path):
+        with open(file_path, 'rb') as file:
+            payload = file.read()
+
+        model_id = await self.derive_model_from_sample_data(model_name, model_version, payload)
+        print(f"Model id = {model_id}")
+        await self.lock_model(model_name, model_version)
+
+    async def derive_model_from_sample_data(self, model_name, model_version, payload):
+        import_model_url = f"{self.api_url}/treeNode/model/import/JSON/SAMPLE_DATA/{model_name}/{model_version}"
+        response = await self._request('POST', import_model_url, content=payload)
+        if response.status_code == 200:
+            return response.text
+        else:
+            raise requests.HTTPError(f"Save failed: {response.status_code} {response.text}")
+
+    async def create_entity(self, model_name, model_version, json_payload):
+        create_entity_url = f"{self.api_url}/entity/JSON/TREE/{model_name}/{model_version}"
+        params = {
+            'transactionTimeoutMillis': '10000'
+        }
+
+        response = await self._request('POST', create_entity_url, params=params, content=json_payload)
+        if response.status_code == 200:
+            return _response_json(response)[0]['entityIds'][0]
+        else:
+            raise requests.HTTPError(f"Save failed: {response.status_code} {response.text}")
+
+    async def create_entities(
+            self,
+            model_name,
+            model_version,
+            records,
+            batch_size=DEFAULT_BATCH_SIZE,
+            batch_bytes=DEFAULT_BATCH_BYTES,
+            max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+            transaction_timeout_millis=10000
+    ):
+        create_entities_url = f"{self.api_url}/entity/JSON/TREE/{model_name}/{model_version}"
+        params = {
+            'transactionTimeoutMillis': f"{transaction_timeout_millis}"
+        }
+
+        result = BulkCreateResult()
+        window = asyncio.Semaphore(max_in_flight)
+
+        async def submit(batch_number, first_index, batch):
+            try:
+                payload = b'[' + b','.join(batch) + b']'
+                ids = await self._post_entities(create_entities_url, params, payload)
+            except Exception as e:
+                result.failures.append(BatchFailure(batch_number, first_index, len(batch), e))
+                ids = []
+            finally:
+                window.release()
+            result._set_ids(first_index, ids[:len(batch)] + [None] * (len(batch) - len(ids)))
+
+        tasks = []
+        next_index = 0
+        for batch_number, batch in enumerate(_batch_records(records, batch_size, batch_bytes)):
+            await window.acquire()
+            tasks.append(asyncio.create_task(submit(batch_number, next_index, batch)))
+            next_index += len(batch)
+        await asyncio.gather(*tasks)
+        result.failures.sort(key=lambda failure: failure.batch_number)
+        return result
+
+    async def _post_entities(self, url, params, payload):
+        response = await self._request('POST', url, params=params, content=payload)
+        if response.status_code == 200:
+            return [entity_id for transaction in _response_json(response) for entity_id in transaction['entityIds']]
+        else:
+            raise requests.HTTPError(f"Save failed: {response.status_code} {response.text}")
+
+    async def get_all_entities(self, model_name, model_version, page_size, page_number):
+        url = f"{self.api_url}/entity/TREE/{model_name}/{model_version}"
+        params = {
+            'pageSize': f"{page_size}",
+            'pageNumber': f"{page_number}"
+        }
+
+        response = await self._request('GET', url, params=params)
+        if response.status_code == 200:
+            return _response_json(response)
+        else:
+            raise requests.HTTPError(f"Get all entities failed: {response.status_code} {response.text}")
+
+    async def create_snapshot_search(self, model_name, model_version, condition):
+        url = f"{self.api_url}/treeNode/search/snapshot/{model_name}/{model_version}"
+        response = await self._request('POST', url, content=JsonBackend.dumps(condition))
+        if response.status_code == 200:
+            return _response_json(response)
+        else:
+            raise requests.HTTPError(f"Snapshot search trigger failed: {response.status_code} {response.text}")
+
+    async def get_snapshot_status(self, snapshot_id):
+        url = f"{self.api_url}/treeNode/search/snapshot/{snapshot_id}/status"
+        response = await self._request('GET', url)
+        if response.status_code == 200:
+            return _response_json(response)
+        else:
+            raise requests.HTTPError(f"Snapshot search status check failed: {response.status_code} {response.text}")
+
+    async def wait_for_search_completion(self, snapshot_id, timeout=DEFAULT_SEARCH_TIMEOUT, interval=None, polling=None):
+        if interval is not None:
+            polling = PollingStrategy(initial_interval=interval / 1000)
+        polling = polling or self.polling
+        start_time = time.monotonic()
+        poll_interval = polling.initial_interval
+        last_entities_count = None
+
+        while True:
+            status_response = await self.get_snapshot_status(snapshot_id)
+            status = status_response.get("snapshotStatus")
+
+            if status == "SUCCESSFUL":
+                return status_response
+            elif status != "RUNNING":
+                raise requests.HTTPError(f"Snapshot search failed: {json.dumps(status_response, indent=4)}")
+
+            elapsed_time = time.monotonic() - start_time
+            if elapsed_time >= timeout:
+                raise TimeoutError(f"Timeout exceeded after {timeout} seconds")
+
+            entities_count = status_response.get("entitiesCount")
+            progressed = None not in (entities_count, last_entities_count) and entities_count > last_entities_count
+            last_entities_count = entities_count
+
+            poll_interval = polling.next_interval(poll_interval, elapsed_time, progressed)
+            await asyncio.sleep(min(polling.jittered(poll_interval), timeout - elapsed_time))
+
+    async def wait_for_many(self, snapshot_ids, timeout=DEFAULT_SEARCH_TIMEOUT, polling=None, return_exceptions=False):
+        snapshot_ids = list(dict.fromkeys(snapshot_ids))
+        results = await asyncio.gather(
+            *(self.wait_for_search_completion(snapshot_id, timeout, polling=polling) for snapshot_id in snapshot_ids),
+            return_exceptions=return_exceptions
+        )
+        return dict(zip(snapshot_ids, results))
+
+    async def get_search_result(self, snapshot_id, page_size, page_number):
+        url = f"{self.api_url}/treeNode/search/snapshot/{snapshot_id}"
+        params = {
+            'pageSize': f"{page_size}",
+            'pageNumber': f"{page_number}"
+        }
+
+        response = await self._request('GET', url, params=params)
+        if response.status_code == 200:
+            return _response_json(response)
+        else:
+            raise requests.HTTPError(f"Get search result failed: {response.status_code} {response.text}")
+
+    async def search_entities(self, model_name, model_version, condition):
+        snapshot_id = await self.create_snapshot_search(model_name, model_version, condition)
+        status_response = await self.wait_for_search_completion(snapshot_id)
+        status_response['snapshotId'] = snapshot_id
+        return status_response
+
+
+def _without_authorization(request):
+    request.headers.pop('Authorization', None)
+    return request
@@ -0,0 +1,209 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from CyodaSession import DEFAULT_PAGE_SIZE, _page_records
+
+DEFAULT_DELETE_WORKERS = 4
+DEFAULT_TRANSACTION_SIZE = 1000
+
+# total is None when the number of entities to delete is not known up front
+DeleteProgress = namedtuple('DeleteProgress', ['deleted', 'total', 'elapsed', 'rate'])
+
+
+def print_progress(progress):
+    deleted = progress.deleted if progress.total is None else f"{progress.deleted}/{progress.total}"
+    print(f"Deleted {deleted} entities in {progress.elapsed:.1f}s ({progress.rate:.0f}/s)")
+
+
+def field_partitions(json_path, values):
+    # One EQUALS condition per value of a field, e.g. field_partitions("$.year", range(1901, 2021)).
+    # To delete everything the values must cover every entity; delete_all removes the rest at the end.
+    return [{"type": "simple", "jsonPath": json_path, "operatorType": "EQUALS", "value": value} for value in values]
+
+
+def _combine(condition, partition):
+    if partition is None or condition is None:
+        return condition if partition is None else partition
+    return {"type": "group", "operator": "AND", "conditions": [condition, partition]}
+
+
+def _entity_id(record):
+    if 'id' in record:
+        return record['id']
+    return record['meta']['id']
+
+
+class BulkDeleter:
+    def __init__(
+            self,
+            session,
+            page_size=DEFAULT_PAGE_SIZE,
+            transaction_size=DEFAULT_TRANSACTION_SIZE,
+            workers=DEFAULT_DELETE_WORKERS,
+            progress=print_progress,
+            checkpoint_path=None
+    ):
+        self.session = session
+        self.page_size = page_size
+        self.transaction_size = transaction_size
+        self.workers = workers
+        self.progress = progress
+        self.checkpoint_path = checkpoint_path
+
+    def delete_all(self, model_name, model_version, partitions=None):
+        # Without partitions every entity is removed by one server-side call, so progress is only known at the
+        # end. With partitions, conditions such as field_partitions() that split the model, each partition is a
+        # server-side bulk delete of its own: they run on the workers, progress is reported and checkpointed as
+        # each one finishes, and a final unconditioned call removes whatever no partition matched.
+        if partitions is None:
+            start_time = time.monotonic()
+            deleted = self.session.delete_all_entities(model_name, model_version, self.page_size,
+                                                       self.transaction_size)
+            self._report(deleted, deleted, start_time)
+            return deleted
+        return self._delete_partitions(model_name, model_version, None, partitions, sweep=True)
+
+    def delete_matching(self, model_name, model_version, condition, partitions=None):
+        # Deletes the entities matching condition with the server-side bulk delete, in one call or, given
+        # partitions, in one concurrent call per partition ANDed with the condition, as delete_all does
+        return self._delete_partitions(model_name, model_version, condition, partitions or [None], sweep=False)
+
+    def delete_matching_per_entity(self, model_name, model_version, condition):
+        # Fallback for servers whose bulk delete does not take a condition: one DELETE request per entity, which
+        # is orders of magnitude slower than delete_matching. The entities are found by a snapshot search and
+        # each page of the snapshot is a partition that a worker deletes on its own; an interrupted run resumes
+        # from the same snapshot and skips the pages that were already deleted.
+        checkpoint = self._resume(model_name, model_version, condition, 'snapshotId')
+        if checkpoint is not None and not self._snapshot_available(checkpoint['snapshotId']):
+            checkpoint = None
+        if checkpoint is None:
+            status_response = self.session.search_entities(model_name, model_version, condition)
+            checkpoint = self._new_checkpoint(model_name, model_version, condition,
+                                              snapshotId=status_response['snapshotId'],
+                                              entitiesCount=status_response.get('entitiesCount', 0),
+                                              pageSize=self.page_size)
+
+        snapshot_id = checkpoint['snapshotId']
+        page_size = checkpoint['pageSize']
+        total = checkpoint['entitiesCount']
+        page_count = -(-total // page_size)
+        first_page = self.session.first_page_number
+        page_numbers = range(first_page, first_page + page_count)
+
+        def delete_page(page_number):
+            return self._delete_page(snapshot_id, page_size, page_number)
+
+        self._run(delete_page, page_numbers, checkpoint, total)
+        self._remove_checkpoint()
+        return checkpoint['deleted']
+
+    def _delete_partitions(self, model_name, model_version, condition, partitions, sweep):
+        checkpoint = self._resume(model_name, model_version, condition, 'partitions')
+        if checkpoint is not None and checkpoint['partitions'] != partitions:
+            checkpoint = None
+        if checkpoint is None:
+            checkpoint = self._new_checkpoint(model_name, model_version, condition, partitions=partitions)
+
+        def delete_partition(index):
+            return self.session.delete_all_entities(model_name, model_version, self.page_size,
+                                                    self.transaction_size, _combine(condition, partitions[index]))
+
+        start_time = self._run(delete_partition, range(len(partitions)), checkpoint, None)
+        if sweep:
+            checkpoint['deleted'] += self.session.delete_all_entities(model_name, model_version, self.page_size,
+                                                                      self.transaction_size)
+            self._report(checkpoint['deleted'], None, start_time)
+        self._remove_checkpoint()
+        return checkpoint['deleted']
+
+    def _run(self, delete, parts, checkpoint, total):
+        # Deletes the parts not completed yet on the workers, recording each finished one in the checkpoint
+        completed = set(checkpoint['completed'])
+        if completed:
+            print(f"Resuming deletion, {len(completed)} parts already deleted")
+        start_time = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(delete, part): part for part in parts if part not in completed}
+            error = None
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                if future.exception() is not None:
+                    # Stop scheduling new parts, but still record the ones that finish in the meantime
+                    error = error or future.exception()
+                    for pending in futures:
+                        pending.cancel()
+                    continue
+                checkpoint['deleted'] += future.result()
+                checkpoint['completed'].append(futures[future])
+                self._save_checkpoint(checkpoint)
+                self._report(checkpoint['deleted'], total, start_time)
+            if error is not None:
+                raise error
+        return start_time
+
+    def _delete_page(self, snapshot_id, page_size, page_number):
+        records = _page_records(self.session.get_search_result(snapshot_id, page_size, page_number))
+        for record in records:
+            # Entities of a page interrupted half way may already be gone when it is retried
+            self.session.delete_entity(_entity_id(record), missing_ok=True)
+        return len(records)
+
+    def _report(self, deleted, total, start_time):
+        if self.progress is not None:
+            elapsed = time.monotonic() - start_time
+            rate = deleted / elapsed if elapsed > 0 else 0.0
+            self.progress(DeleteProgress(deleted, total, elapsed, rate))
+
+    def _new_checkpoint(self, model_name, model_version, condition, **fields):
+        checkpoint = {
+            'modelName': model_name,
+            'modelVersion': str(model_version),
+            'condition': condition,
+            'completed': [],
+            'deleted': 0,
+            **fields
+        }
+        self._save_checkpoint(checkpoint)
+        return checkpoint
+
+    def _resume(self, model_name, model_version, condition, kind):
+        # The checkpoint of an interrupted run of the same kind (partitions or snapshotId) and deletion, if any
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path, 'r') as file:
+            checkpoint = json.load(file)
+        if kind not in checkpoint or \
+                (checkpoint.get('modelName'), checkpoint.get('modelVersion'), checkpoint.get('condition')) != \
+                (model_name, str(model_version), condition):
+            return None
+        return checkpoint
+
+    def _snapshot_available(self, snapshot_id):
+        # The snapshot may have expired since the interruption; a fresh search then only finds what is left
+        try:
+            status_response = self.session.get_snapshot_status(snapshot_id)
+        except requests.HTTPError:
+            return False
+        return status_response.get('snapshotStatus') == 'SUCCESSFUL'
+
+    def _save_checkpoint(self, checkpoint):
+        if not self.checkpoint_path:
+            return
+        temp_path = f"{self.checkpoint_path}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(checkpoint, file)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def _remove_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
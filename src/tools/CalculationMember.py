@@ -0,0 +1,416 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import asyncio
+import inspect
+import multiprocessing
+import queue
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import JsonBackend
+
+try:
+    import grpc
+except ImportError:  # optional, only needed to run a calculation member
+    grpc = None
+
+STREAMING_METHOD = "/org.cyoda.cloud.api.grpc.CloudEventsService/startStreaming"
+CLOUD_EVENT_SOURCE = "CyodaSession"
+CLOUD_EVENT_SPEC_VERSION = "1.0"
+
+# CloudEvent types, see src/main/resources/schema/common/CloudEventType.json
+JOIN_EVENT = "CalculationMemberJoinEvent"
+GREET_EVENT = "CalculationMemberGreetEvent"
+KEEP_ALIVE_EVENT = "CalculationMemberKeepAliveEvent"
+ACK_RESPONSE = "EventAckResponse"
+PROCESSOR_REQUEST = "EntityProcessorCalculationRequest"
+PROCESSOR_RESPONSE = "EntityProcessorCalculationResponse"
+CRITERIA_REQUEST = "EntityCriteriaCalculationRequest"
+CRITERIA_RESPONSE = "EntityCriteriaCalculationResponse"
+
+DEFAULT_GRPC_PORT = 443
+DEFAULT_TAGS = ("default",)
+DEFAULT_MAX_IN_FLIGHT_CALCULATIONS = 64
+DEFAULT_THREAD_WORKERS = 16
+DEFAULT_RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+
+_CLOSE = object()
+
+# The stream carries io.cloudevents.v1.CloudEvent messages (src/main/resources/proto/cloudevents.proto). Only
+# their string fields are used, so they are encoded and decoded here directly instead of through classes
+# generated from the proto files, and grpc is the only dependency.
+_ID = 1
+_SOURCE = 2
+_SPEC_VERSION = 3
+_TYPE = 4
+_BINARY_DATA = 6
+_TEXT_DATA = 7
+_LENGTH_DELIMITED = 2
+
+
+class CloudEvent:
+    __slots__ = ("id", "source", "type", "data")
+
+    def __init__(self, event_id, source, event_type, data):
+        self.id = event_id
+        self.source = source
+        self.type = event_type
+        self.data = data
+
+    def json(self):
+        return JsonBackend.loads(self.data) if self.data else {}
+
+
+def _varint(value):
+    encoded = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if not value:
+            encoded.append(bits)
+            return bytes(encoded)
+        encoded.append(bits | 0x80)
+
+
+def _read_varint(message, position):
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(message):
+            raise ValueError("Truncated varint in CloudEvent")
+        byte = message[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def encode_cloud_event(event_type, data, event_id=None, source=CLOUD_EVENT_SOURCE):
+    # data is the JSON of the event as UTF-8 bytes, sent as text_data
+    fields = (
+        (_ID, (event_id or str(uuid.uuid4())).encode("utf-8")),
+        (_SOURCE, source.encode("utf-8")),
+        (_SPEC_VERSION, CLOUD_EVENT_SPEC_VERSION.encode("utf-8")),
+        (_TYPE, event_type.encode("utf-8")),
+        (_TEXT_DATA, data),
+    )
+    encoded = bytearray()
+    for number, value in fields:
+        encoded += _varint(number << 3 | _LENGTH_DELIMITED)
+        encoded += _varint(len(value))
+        encoded += value
+    return bytes(encoded)
+
+
+def decode_cloud_event(message):
+    # Attributes and proto_data are skipped, text_data and binary_data both end up in data as bytes
+    values = {}
+    position = 0
+    while position < len(message):
+        key, position = _read_varint(message, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            _, position = _read_varint(message, position)
+        elif wire_type == 1:
+            position += 8
+        elif wire_type == 5:
+            position += 4
+        elif wire_type == _LENGTH_DELIMITED:
+            length, position = _read_varint(message, position)
+            values[number] = message[position:position + length]
+            position += length
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type} in CloudEvent field {number}")
+    data = values.get(_TEXT_DATA, values.get(_BINARY_DATA, b""))
+    return CloudEvent(
+        values.get(_ID, b"").decode("utf-8"),
+        values.get(_SOURCE, b"").decode("utf-8"),
+        values.get(_TYPE, b"").decode("utf-8"),
+        bytes(data)
+    )
+
+
+def calculation_response(request, error_code=None, error_message=None):
+    # Mirrors asResponse() of the Kotlin client: the response answers the request's id, requestId and entityId
+    response = {
+        "id": request.get("id"),
+        "requestId": request.get("requestId"),
+        "entityId": request.get("entityId"),
+        "success": error_code is None,
+    }
+    if error_code is not None:
+        response["error"] = {"code": error_code, "message": error_message}
+    return response
+
+
+def _require_grpc():
+    if grpc is None:
+        raise ImportError("The calculation member needs the grpcio package, install it with pip install grpcio")
+
+
+class CalculationMember:
+    def __init__(
+            self,
+            session,
+            grpc_server,
+            grpc_port=DEFAULT_GRPC_PORT,
+            use_tls=True,
+            tags=DEFAULT_TAGS,
+            max_in_flight=DEFAULT_MAX_IN_FLIGHT_CALCULATIONS,
+            max_pending=None,
+            process_workers=None,
+            thread_workers=DEFAULT_THREAD_WORKERS,
+            reconnect_delay=DEFAULT_RECONNECT_DELAY
+    ):
+        # Serves processor and criteria requests of the Cyoda workflow over one CloudEventsService.startStreaming
+        # stream, as CyodaCalculationMemberClient does in Kotlin. Functions registered as cpu_bound run on a process
+        # pool, plain functions on a thread pool and coroutine functions on an asyncio event loop. At most
+        # max_in_flight calculations run at a time and up to max_pending more (max_in_flight by default) wait for a
+        # slot. Keep-alives and greets are answered as they are read, so they are acked while every slot is busy;
+        # only once the pending queue is full as well does the reader block, and gRPC flow control holds the
+        # server back until a calculation finishes. Responses are sent as soon as their calculation finishes,
+        # in any order.
+        _require_grpc()
+        self.session = session
+        self.target = f"{grpc_server}:{grpc_port}"
+        self.use_tls = use_tls
+        self.tags = list(tags)
+        self.process_workers = process_workers
+        self.reconnect_delay = reconnect_delay
+
+        self.member_id = None
+        self.joined = threading.Event()
+        self.stats = {"processed": 0, "failed": 0, "keepAlives": 0}
+
+        self._processors = {}
+        self._criteria = {}
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._stats_lock = threading.Lock()
+        self._outgoing = queue.Queue()
+        self._pending = queue.Queue(maxsize=max_in_flight if max_pending is None else max_pending)
+        self._call = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self._thread_pool = ThreadPoolExecutor(max_workers=thread_workers, thread_name_prefix="CalculationMember")
+        self._process_pool = None
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add_processor(self, name, function, cpu_bound=False):
+        # function(request) gets the EntityProcessorCalculationRequest as a dict and returns the new entity data,
+        # or None to leave it unchanged. cpu_bound functions must be picklable, i.e. defined at module level.
+        self._register(self._processors, name, function, cpu_bound)
+
+    def add_criteria(self, name, function, cpu_bound=False):
+        # function(request) gets the EntityCriteriaCalculationRequest as a dict and returns whether it matches
+        self._register(self._criteria, name, function, cpu_bound)
+
+    def _register(self, registry, name, function, cpu_bound):
+        if cpu_bound and inspect.iscoroutinefunction(function):
+            raise ValueError(f"{name} is a coroutine function, it can not run on the process pool")
+        if cpu_bound and self._process_pool is None:
+            # Worker processes are spawned, not forked, as forking a process with live gRPC threads is unsafe
+            self._process_pool = ProcessPoolExecutor(max_workers=self.process_workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+        registry[name] = (function, cpu_bound)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="CalculationMember", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        call = self._call
+        if call is not None:
+            call.cancel()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        # Streams until stop() is called, reconnecting with exponential backoff when the stream breaks
+        delay = self.reconnect_delay
+        dispatcher = threading.Thread(target=self._dispatch_pending, name="CalculationMember-dispatch", daemon=True)
+        dispatcher.start()
+        try:
+            while not self._stopping.is_set():
+                try:
+                    self._stream()
+                    print("Calculation stream closed by the server")
+                except Exception as e:
+                    # Login and token failures, as well as gRPC errors, are retried like a broken stream
+                    if self._stopping.is_set():
+                        break
+                    if isinstance(e, grpc.RpcError) and isinstance(e, grpc.Call):
+                        print(f"Calculation stream failed: {e.code()} {e.details()}")
+                    else:
+                        print(f"Calculation stream failed: {type(e).__name__}: {e}")
+                if self.joined.is_set():
+                    delay = self.reconnect_delay
+                if self._stopping.wait(delay):
+                    break
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        finally:
+            self._pending.put(_CLOSE)
+            dispatcher.join()
+            self._thread_pool.shutdown(wait=True)
+            if self._process_pool is not None:
+                self._process_pool.shutdown(wait=True)
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _stream(self):
+        self.joined.clear()
+        outgoing = queue.Queue()
+        self._outgoing = outgoing
+        self._send(JOIN_EVENT, {"id": str(uuid.uuid4()), "tags": self.tags})
+
+        if self.use_tls:
+            channel = grpc.secure_channel(self.target, grpc.ssl_channel_credentials())
+        else:
+            channel = grpc.insecure_channel(self.target)
+        try:
+            # Without serializers the stream sends and receives the encoded CloudEvents as they are
+            start_streaming = channel.stream_stream(STREAMING_METHOD)
+            metadata = (("authorization", f"Bearer {self.session.token_manager.get_access_token()}"),)
+            self._call = start_streaming(self._requests(outgoing), metadata=metadata)
+            if self._stopping.is_set():
+                self._call.cancel()
+            for message in self._call:
+                try:
+                    event = decode_cloud_event(message)
+                except ValueError as e:
+                    print(f"Skipped an undecodable CloudEvent: {e}")
+                    continue
+                self._handle(event)
+        finally:
+            self._call = None
+            outgoing.put(_CLOSE)
+            channel.close()
+
+    @staticmethod
+    def _requests(outgoing):
+        while True:
+            message = outgoing.get()
+            if message is _CLOSE:
+                return
+            yield message
+
+    def _send(self, event_type, event):
+        # Calculations finishing after a reconnect answer on the new stream
+        self._outgoing.put(encode_cloud_event(event_type, JsonBackend.dumps(event)))
+
+    def _handle(self, event):
+        # Runs on the stream reader: calculation requests are queued for a free slot, blocking the reader while the
+        # pending queue is full, while keep-alives and greets are answered straight away
+        if event.type in (PROCESSOR_REQUEST, CRITERIA_REQUEST):
+            self._pending.put(event)
+        elif event.type == KEEP_ALIVE_EVENT:
+            body = self._body(event)
+            if body is None:
+                return
+            with self._stats_lock:
+                self.stats["keepAlives"] += 1
+            self._send(ACK_RESPONSE, {"id": str(uuid.uuid4()), "sourceEventId": body.get("id"), "success": True})
+        elif event.type == GREET_EVENT:
+            body = self._body(event)
+            if body is None:
+                return
+            self.member_id = body.get("memberId")
+            print(f"Joined as calculation member {self.member_id}")
+            self.joined.set()
+
+    @staticmethod
+    def _body(event):
+        # The JSON object of the event, or None when it can not be decoded, in which case the event is skipped
+        try:
+            body = event.json()
+        except ValueError as e:
+            print(f"Skipped {event.type} event {event.id}: {e}")
+            return None
+        if not isinstance(body, dict):
+            print(f"Skipped {event.type} event {event.id}: the data is not a JSON object")
+            return None
+        return body
+
+    def _dispatch_pending(self):
+        while True:
+            event = self._pending.get()
+            if event is _CLOSE:
+                return
+            if self._stopping.is_set():
+                continue
+            if event.type == PROCESSOR_REQUEST:
+                self._dispatch(event, self._processors, PROCESSOR_RESPONSE, "UNKNOWN PROCESSOR", "processorName")
+            else:
+                self._dispatch(event, self._criteria, CRITERIA_RESPONSE, "UNKNOWN CRITERIA", "criteriaName")
+
+    def _dispatch(self, event, registry, response_type, unknown_code, name_field):
+        # Without a decodable body there is no requestId to answer, so the server times the request out
+        request = self._body(event)
+        if request is None:
+            return
+        name = request.get(name_field)
+        if name not in registry:
+            self._send(response_type, calculation_response(request, unknown_code, f"{name} not supported."))
+            return
+
+        function, cpu_bound = registry[name]
+        # Only this dispatcher waits for a free slot, the stream reader goes on until the pending queue is full
+        self._slots.acquire()
+        try:
+            if inspect.iscoroutinefunction(function):
+                future = asyncio.run_coroutine_threadsafe(function(request), self._event_loop())
+            elif cpu_bound:
+                future = self._process_pool.submit(function, request)
+            else:
+                future = self._thread_pool.submit(function, request)
+        except Exception as e:
+            # E.g. a broken process pool, answered like a failed calculation
+            self._slots.release()
+            with self._stats_lock:
+                self.stats["failed"] += 1
+            self._send(response_type, calculation_response(request, "EXCEPTION", str(e)))
+            return
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda done: self._complete(done, request, response_type))
+
+    def _complete(self, future, request, response_type):
+        try:
+            try:
+                result = future.result()
+            except Exception as e:
+                response = calculation_response(request, "EXCEPTION", str(e))
+            else:
+                response = calculation_response(request)
+                if response_type == CRITERIA_RESPONSE:
+                    response["matches"] = bool(result)
+                elif result is not None:
+                    payload_type = (request.get("payload") or {}).get("type", "TREE")
+                    response["payload"] = {"type": payload_type, "data": result}
+            with self._stats_lock:
+                self.stats["processed" if response["success"] else "failed"] += 1
+            self._send(response_type, response)
+        finally:
+            self._slots.release()
+
+    def _event_loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="CalculationMember-asyncio", daemon=True).start()
+            return self._loop
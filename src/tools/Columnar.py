@@ -0,0 +1,219 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import re
+
+try:
+    import numpy
+except ImportError:  # optional, only needed for output='numpy'
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:  # optional, only needed for output='arrow'
+    pyarrow = None
+
+DEFAULT_COLUMN_BATCH_SIZE = 65536
+OUTPUTS = ('numpy', 'arrow', 'lists')
+
+_PATH_STEP = re.compile(r"\.([^.\[\]]+)|\[(\*|\d+)\]|\['([^']*)'\]")
+_WILDCARD = object()
+
+
+def compile_json_path(json_path):
+    # '$.laureates[*].surname' -> ['laureates', _WILDCARD, 'surname']
+    if not json_path.startswith('$'):
+        raise ValueError(f"jsonPath must start with '$': {json_path}")
+    steps = []
+    position = 1
+    while position < len(json_path):
+        match = _PATH_STEP.match(json_path, position)
+        if match is None:
+            raise ValueError(f"Unsupported jsonPath syntax at position {position}: {json_path}")
+        key, index, quoted = match.groups()
+        if key is not None:
+            steps.append(key)
+        elif quoted is not None:
+            steps.append(quoted)
+        elif index == '*':
+            steps.append(_WILDCARD)
+        else:
+            steps.append(int(index))
+        position = match.end()
+    return steps
+
+
+def _select(value, steps):
+    # All values matched by the steps, in document order
+    values = [value]
+    for step in steps:
+        selected = []
+        for current in values:
+            if step is _WILDCARD:
+                if isinstance(current, list):
+                    selected.extend(current)
+            elif isinstance(step, int):
+                if isinstance(current, list) and -len(current) <= step < len(current):
+                    selected.append(current[step])
+            elif isinstance(current, dict) and step in current:
+                selected.append(current[step])
+        values = selected
+    return values
+
+
+def _get(value, steps):
+    # Fast path for paths without a wildcard
+    for step in steps:
+        if isinstance(step, int):
+            if not isinstance(value, list) or not -len(value) <= step < len(value):
+                return None
+        elif not isinstance(value, dict):
+            return None
+        value = value.get(step) if isinstance(value, dict) else value[step]
+    return value
+
+
+def record_document(record):
+    # Entities come back wrapped as {"meta": {...}, "data": {...}}; paths are evaluated against the data
+    if isinstance(record, dict) and 'data' in record and 'meta' in record:
+        return record['data']
+    return record
+
+
+class ColumnarBuilder:
+    # Flattens records into one column per jsonPath while they stream in. Rows are buffered as Python values
+    # for at most batch_size records and then converted into a typed chunk, so a large snapshot is never
+    # held as nested dicts. Paths with [*] give a list per record, or with explode=True one row per element
+    # where single valued columns repeat and shorter lists are padded with None.
+    def __init__(self, columns, output='numpy', explode=False, batch_size=DEFAULT_COLUMN_BATCH_SIZE):
+        if output not in OUTPUTS:
+            raise ValueError(f"output must be one of {OUTPUTS}, not {output}")
+        if output == 'numpy':
+            _require(numpy, 'numpy')
+        elif output == 'arrow':
+            _require(pyarrow, 'pyarrow')
+
+        if not isinstance(columns, dict):
+            columns = {json_path: json_path for json_path in columns}
+        self.names = list(columns)
+        self.output = output
+        self.explode = explode
+        self.batch_size = batch_size
+        self._paths = []
+        for name in self.names:
+            steps = compile_json_path(columns[name])
+            self._paths.append((steps, _WILDCARD in steps))
+        self._buffers = {name: [] for name in self.names}
+        self._buffered = 0
+        self._chunks = {name: [] for name in self.names}
+        self.rows = 0
+
+    def add_page(self, page):
+        records = page.get('content', []) if isinstance(page, dict) else page
+        self.add_records(records)
+
+    def add_records(self, records):
+        for record in records:
+            self.add_record(record)
+
+    def add_record(self, record):
+        document = record_document(record)
+        values = [_select(document, steps) if multiple else _get(document, steps)
+                  for steps, multiple in self._paths]
+
+        if self.explode and any(multiple for _, multiple in self._paths):
+            length = max(1, max(len(value) for value, (_, multiple) in zip(values, self._paths) if multiple))
+            for index in range(length):
+                for name, value, (_, multiple) in zip(self.names, values, self._paths):
+                    if multiple:
+                        self._buffers[name].append(value[index] if index < len(value) else None)
+                    else:
+                        self._buffers[name].append(value)
+            self._buffered += length
+        else:
+            for name, value in zip(self.names, values):
+                self._buffers[name].append(value)
+            self._buffered += 1
+
+        if self._buffered >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        for name in self.names:
+            values = self._buffers[name]
+            if self.output == 'numpy':
+                self._chunks[name].append(_numpy_chunk(values))
+            elif self.output == 'arrow':
+                self._chunks[name].append(pyarrow.array(values))
+            else:
+                self._chunks[name].append(values)
+            self._buffers[name] = []
+        self.rows += self._buffered
+        self._buffered = 0
+
+    def result(self):
+        # numpy: dict of arrays, arrow: pyarrow.Table (table.to_batches() for record batches), lists: dict of lists
+        self._flush()
+        if self.output == 'numpy':
+            return {name: _concatenate_numpy(self._chunks[name]) for name in self.names}
+        if self.output == 'arrow':
+            return pyarrow.table({name: _unify_arrow(name, self._chunks[name]) for name in self.names})
+        return {name: [value for chunk in self._chunks[name] for value in chunk] for name in self.names}
+
+
+def read_columns(records, columns, output='numpy', explode=False, batch_size=DEFAULT_COLUMN_BATCH_SIZE):
+    builder = ColumnarBuilder(columns, output, explode, batch_size)
+    builder.add_records(records)
+    return builder.result()
+
+
+def _require(module, name):
+    if module is None:
+        raise ImportError(f"{name} output needs the {name} package, install it with pip install {name}")
+
+
+def _numpy_chunk(values):
+    kinds = {type(value) for value in values if value is not None}
+    has_none = len(kinds) == 0 or any(value is None for value in values)
+    if kinds and kinds <= {bool} and not has_none:
+        return numpy.array(values, dtype=bool)
+    if kinds and kinds <= {int} and not has_none:
+        return numpy.array(values, dtype=numpy.int64)
+    if kinds and kinds <= {int, float}:
+        return numpy.array([numpy.nan if value is None else value for value in values], dtype=numpy.float64)
+    if kinds and kinds <= {str} and not has_none:
+        return numpy.array(values, dtype=str)
+    # Mixed values, missing strings and lists keep their Python objects
+    chunk = numpy.empty(len(values), dtype=object)
+    for index, value in enumerate(values):
+        chunk[index] = value
+    return chunk
+
+
+def _concatenate_numpy(chunks):
+    if not chunks:
+        return numpy.empty(0, dtype=object)
+    kinds = {chunk.dtype.kind for chunk in chunks}
+    if kinds <= {'b', 'i', 'f'} or kinds == {'U'}:
+        return numpy.concatenate(chunks)
+    return numpy.concatenate([chunk.astype(object) for chunk in chunks])
+
+
+def _unify_arrow(name, chunks):
+    # Each chunk infers its own type; a column that was all null in one chunk or integer in one and
+    # floating point in another is cast to the first type every chunk converts to
+    candidates = []
+    for chunk in chunks:
+        if chunk.type != pyarrow.null() and chunk.type not in candidates:
+            candidates.append(chunk.type)
+    if not candidates:
+        return pyarrow.chunked_array(chunks, type=pyarrow.null())
+    for candidate in candidates:
+        try:
+            return pyarrow.chunked_array([chunk.cast(candidate) for chunk in chunks], type=candidate)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError, pyarrow.ArrowTypeError):
+            continue
+    raise ValueError(f"Column {name} mixes incompatible types {[str(candidate) for candidate in candidates]}")
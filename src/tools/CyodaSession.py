@@ -3,15 +3,348 @@
 #  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
 #  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import time
+import heapq
+import random
 from datetime import datetime
 import tzlocal  # For detecting local timezone
 from pathlib import Path
 import getpass
 import os
+import queue
+import threading
+import copy
+import mmap
+import zlib
+from collections.abc import Iterator
+from contextlib import contextmanager
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import JsonBackend
+from Columnar import ColumnarBuilder
+from Instrumentation import Instrumentation
+from ModelSchema import SchemaChangeError, export_schema, infer_file_schema, schema_additions, schema_fingerprint
+from Resilience import IDEMPOTENT_METHODS, Resilience
+from TokenManager import TokenCache, TokenManager
 
 APPLICATION_JSON = 'application/json'
+DEFAULT_POOL_SIZE = 10
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_BYTES = 8 * 1024 * 1024
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_PREFETCH_PAGES = 2
+# The page numbering of the entity and snapshot page endpoints could not be confirmed against the platform from
+# this repository. The default follows its only caller, bootstrap_cyoda_env.ipynb, which asks for page 1 as the
+# first page. Pass first_page_number=0 to CyodaSession for an environment that counts pages from 0.
+FIRST_PAGE_NUMBER = 1
+DEFAULT_PARALLELISM = 4
+DEFAULT_SEARCH_TIMEOUT = 300
+DEFAULT_MODEL_CACHE_TTL = 30
+DEFAULT_UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# What reset_model may do to a model whose entities would be lost
+WIPE_NEVER = 'never'
+WIPE_IF_NEEDED = 'if_needed'
+WIPE_ALWAYS = 'always'
+
+ModelExport = namedtuple('ModelExport', ['status_code', 'model', 'text', 'etag', 'fetched_at'])
+
+
+class BatchFailure:
+    def __init__(self, batch_number, first_index, size, error):
+        self.batch_number = batch_number
+        self.first_index = first_index
+        self.size = size
+        self.error = error
+
+    def __repr__(self):
+        return f"BatchFailure(batch_number={self.batch_number}, first_index={self.first_index}, " \
+               f"size={self.size}, error={self.error!r})"
+
+
+class BulkCreateResult:
+    def __init__(self):
+        # Entity ids in input order, None for records of a failed batch
+        self.entity_ids = []
+        self.failures = []
+
+    @property
+    def ok(self):
+        return not self.failures
+
+    def _set_ids(self, first_index, ids):
+        missing = first_index + len(ids) - len(self.entity_ids)
+        if missing > 0:
+            self.entity_ids.extend([None] * missing)
+        self.entity_ids[first_index:first_index + len(ids)] = ids
+
+
+class PollingStrategy:
+    # Exponential backoff with jitter for status polling. The interval stops growing while the polled
+    # search reports progress, and never drops below a fraction of the time already spent waiting,
+    # so long-running searches are polled proportionally less often.
+    def __init__(
+            self,
+            initial_interval=0.05,
+            max_interval=5.0,
+            multiplier=2.0,
+            jitter=0.2,
+            elapsed_fraction=0.1
+    ):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.elapsed_fraction = elapsed_fraction
+
+    def next_interval(self, interval, elapsed, progressed=False):
+        if not progressed:
+            interval *= self.multiplier
+        interval = max(interval, elapsed * self.elapsed_fraction)
+        return min(interval, self.max_interval)
+
+    def jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+def read_password(password_file_path):
+    password_file = Path(password_file_path)
+    if password_file.exists():
+        with password_file.open('r') as file:
+            return file.read().rstrip()
+    return getpass.getpass("Enter your password: ")
+
+
+def _page_records(page):
+    if isinstance(page, dict):
+        return page.get('content', [])
+    return page
+
+
+def _iter_pages(fetch_page, page_size, prefetch, first_page=FIRST_PAGE_NUMBER):
+    # Yields the records of consecutive pages until a short page is returned. With prefetch > 0 a
+    # background thread keeps up to that many pages buffered while the current one is consumed.
+    if prefetch <= 0:
+        page_number = first_page
+        while True:
+            records = _page_records(fetch_page(page_size, page_number))
+            yield from records
+            if len(records) < page_size:
+                return
+            page_number += 1
+
+    pages = queue.Queue(maxsize=prefetch)
+    stopped = threading.Event()
+
+    def offer(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        page_number = first_page
+        try:
+            while True:
+                records = _page_records(fetch_page(page_size, page_number))
+                if not offer((records, None)) or len(records) < page_size:
+                    break
+                page_number += 1
+        except Exception as e:
+            offer((None, e))
+        offer((None, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            records, error = pages.get()
+            if error is not None:
+                raise error
+            if records is None:
+                return
+            yield from records
+    finally:
+        stopped.set()
+
+
+def _fan_out_pages(fetch_page, page_size, page_numbers, parallelism, ordered):
+    # Fetches a known range of pages from a worker pool. Only a window of 2 * parallelism pages is
+    # outstanding at any time, so a slow consumer does not make the whole snapshot pile up in memory.
+    page_numbers = iter(page_numbers)
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        pending = deque()
+
+        def submit_next():
+            page_number = next(page_numbers, None)
+            if page_number is not None:
+                pending.append(executor.submit(fetch_page, page_size, page_number))
+
+        try:
+            for _ in range(2 * parallelism):
+                submit_next()
+
+            while pending:
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                for future in done:
+                    submit_next()
+                    yield from _page_records(future.result())
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _encode_record(record):
+    if isinstance(record, (bytes, bytearray)):
+        return bytes(record)
+    if isinstance(record, str):
+        return record.encode('utf-8')
+    return JsonBackend.dumps(record)
+
+
+UploadProgress = namedtuple('UploadProgress', ['read', 'sent', 'total', 'elapsed'])
+
+
+class StreamingBody:
+    # A request body that requests sends with chunked transfer encoding. The source is read one chunk at
+    # a time and optionally gzip compressed on the fly, so memory use does not grow with its size. Paths,
+    # seekable files and in-memory payloads are read again from the start on every iteration and can be
+    # replayed by retries; iterators and generators can only be sent once.
+    def __init__(self, source, compress=False, progress=None, chunk_size=DEFAULT_UPLOAD_CHUNK_SIZE):
+        self.source = source
+        self.compress = compress
+        self.progress = progress
+        self.chunk_size = chunk_size
+        seekable = hasattr(source, 'seek') and hasattr(source, 'tell')
+        self._start = source.tell() if seekable else None
+        self.replayable = seekable or not isinstance(source, Iterator)
+        self._consumed = False
+
+    @property
+    def headers(self):
+        return {'Content-Encoding': 'gzip'} if self.compress else None
+
+    @property
+    def total(self):
+        # Size of the uncompressed source when it is known up front
+        if isinstance(self.source, os.PathLike):
+            return os.path.getsize(self.source)
+        if isinstance(self.source, (bytes, bytearray, mmap.mmap)):
+            return len(self.source) - (self._start or 0)
+        if self._start is not None and hasattr(self.source, 'fileno'):
+            try:
+                return os.fstat(self.source.fileno()).st_size - self._start
+            except OSError:
+                return None
+        return None
+
+    def __iter__(self):
+        if self._consumed and not self.replayable:
+            raise requests.exceptions.StreamConsumedError(
+                "The request body was generated once and cannot be sent again")
+        self._consumed = True
+
+        compressor = zlib.compressobj(wbits=31) if self.compress else None
+        total = self.total
+        start_time = time.monotonic()
+        read = sent = 0
+        for chunk in self._read_chunks():
+            read += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                sent += len(chunk)
+                yield chunk
+            self._report(read, sent, total, start_time)
+        if compressor is not None:
+            chunk = compressor.flush()
+            sent += len(chunk)
+            yield chunk
+            self._report(read, sent, total, start_time)
+
+    def _read_chunks(self):
+        source = self.source
+        if isinstance(source, os.PathLike):
+            with open(source, 'rb') as file:
+                yield from iter(lambda: file.read(self.chunk_size), b'')
+        elif isinstance(source, str):
+            yield from _encoded_chunks(source[offset:offset + self.chunk_size]
+                                       for offset in range(0, len(source), self.chunk_size))
+        elif isinstance(source, (bytes, bytearray, mmap.mmap)):
+            for offset in range(self._start or 0, len(source), self.chunk_size):
+                yield bytes(source[offset:offset + self.chunk_size])
+        elif hasattr(source, 'read'):
+            if self._start is not None:
+                source.seek(self._start)
+            yield from _encoded_chunks(iter(lambda: source.read(self.chunk_size), source.read(0)))
+        else:
+            yield from _encoded_chunks(source)
+
+    def _report(self, read, sent, total, start_time):
+        if self.progress is not None:
+            self.progress(UploadProgress(read, sent, total, time.monotonic() - start_time))
+
+
+def _encoded_chunks(chunks):
+    for chunk in chunks:
+        yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+
+@contextmanager
+def _open_payload(payload, compress=False, progress=None):
+    # Payloads are sent without being parsed: str and bytes as they are, file objects and memory-mapped
+    # files streamed from their current position, and path-like objects memory-mapped from disk.
+    # Python objects are the only payloads that get encoded. Iterators, and any payload that is to be
+    # compressed or report progress, are streamed with chunked transfer encoding.
+    if isinstance(payload, (dict, list)):
+        payload = JsonBackend.dumps(payload)
+    if compress or progress is not None or (isinstance(payload, Iterator) and not hasattr(payload, 'read')):
+        yield StreamingBody(payload, compress, progress)
+    elif isinstance(payload, os.PathLike):
+        with open(payload, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                yield b''
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+    else:
+        yield payload
+
+
+def _payload_headers(data):
+    return data.headers if isinstance(data, StreamingBody) else None
+
+
+def _response_json(response):
+    return JsonBackend.loads(response.content)
+
+
+def _batch_records(records, batch_size, batch_bytes):
+    # Lazily groups encoded records so that only the batches in flight are held in memory
+    batch = []
+    batch_length = 2
+    for record in records:
+        encoded = _encode_record(record)
+        if batch and (len(batch) >= batch_size or batch_length + len(encoded) + 1 > batch_bytes):
+            yield batch
+            batch = []
+            batch_length = 2
+        batch.append(encoded)
+        batch_length += len(encoded) + 1
+    if batch:
+        yield batch
 
 
 class CyodaSession:
@@ -20,15 +353,49 @@ class CyodaSession:
             api_url,
             username='demo.user',
             password_file_path='/Users/paul/.cyoda/demo.passwd',
-            password_env_value='DEMO_USER_PASSWD'
+            password_env_value='DEMO_USER_PASSWD',
+            pool_connections=DEFAULT_POOL_SIZE,
+            pool_maxsize=DEFAULT_POOL_SIZE,
+            pool_block=False,
+            timeout=None,
+            token_cache_path=None,
+            model_cache_ttl=DEFAULT_MODEL_CACHE_TTL,
+            resilience=None,
+            instrumentation=None,
+            search_cache=None,
+            first_page_number=FIRST_PAGE_NUMBER
     ):
         self.api_url = api_url
-        self.login_endpoint = f"{api_url}/auth/login",
-        self.token_endpoint = f"{api_url}/auth/token",
+        self.login_endpoint = f"{api_url}/auth/login"
+        self.token_endpoint = f"{api_url}/auth/token"
         self.username = username
         self.password = os.getenv(password_env_value, None)
         self.password_file_path = password_file_path
+        self.timeout = timeout
+        self.first_page_number = first_page_number
+
+        # One pooled keep-alive transport per session, so connections (and their TLS handshakes)
+        # are reused across calls instead of being set up for every request
+        self.http = self._create_http_session(pool_connections, pool_maxsize, pool_block)
+        self.resilience = resilience or Resilience()
+        self.instrumentation = instrumentation or Instrumentation()
+        self.token_manager = TokenManager(
+            login=self._login,
+            fetch_access_token=self._fetch_access_token,
+            cache=TokenCache(token_cache_path) if token_cache_path else None,
+            cache_key=f"{username}@{api_url}"
+        )
         self.access_token = ""
+        self.polling = PollingStrategy()
+
+        # SIMPLE_VIEW exports per (model name, model version), shared by model_exists, get_model and get_model_state
+        self.model_cache_ttl = model_cache_ttl
+        self._model_cache = {}
+        self._model_cache_lock = threading.Lock()
+
+        # Completed snapshot searches (and optionally their pages), reused by search_entities until
+        # shortly before the snapshot expires. Pass SearchCache() to enable it.
+        self.search_cache = search_cache
 
         # Retrieve or ask for password if not set
         if not self.password:
@@ -40,71 +407,188 @@ class CyodaSession:
         }
 
     def _get_password(self):
-        password_file = Path(self.password_file_path)
-        if password_file.exists():
-            with password_file.open('r') as file:
-                return file.read().rstrip()
-        return getpass.getpass("Enter your password: ")
+        return read_password(self.password_file_path)
+
+    @staticmethod
+    def _create_http_session(pool_connections, pool_maxsize, pool_block):
+        http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        http.mount('https://', adapter)
+        http.mount('http://', adapter)
+        http.headers['Content-Type'] = APPLICATION_JSON
+        return http
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.http.close()
+
+    @property
+    def access_token(self):
+        return self._access_token
+
+    @access_token.setter
+    def access_token(self, token):
+        # The default auth header is built once per token instead of on every request
+        self._access_token = token
+        if token:
+            self.http.headers['Authorization'] = f'Bearer {token}'
+            self.token_manager.set_tokens(access_token=token)
+        else:
+            self.http.headers.pop('Authorization', None)
+
+    def _request(self, method, url, authenticate=True, idempotent=None, **kwargs):
+        # Every call goes through the shared retry, rate limiting and circuit breaker layer. Requests that
+        # are not idempotent are only repeated when the server did not process them. Login and token calls
+        # (authenticate=False) run inside other calls, so they are neither limited nor guarded by the breaker.
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        # A file-like body is rewound before every attempt, so that retries send it in full again.
+        # A body generated on the fly can only be sent once and is never retried.
+        data = kwargs.get('data')
+        body_position = data.tell() if hasattr(data, 'seek') and hasattr(data, 'tell') else None
+        replayable = getattr(data, 'replayable', True)
+        max_retries = None if replayable else 0
+
+        def send():
+            return self._send(method, url, authenticate, body_position, replayable, **kwargs)
+
+        if not self.instrumentation.enabled:
+            return self.resilience.execute(send, idempotent, limited=authenticate, max_retries=max_retries,
+                                           guarded=authenticate)
+
+        def execute(stats):
+            return self.resilience.execute(send, idempotent, limited=authenticate, stats=stats,
+                                           max_retries=max_retries, guarded=authenticate)
+
+        return self.instrumentation.observe(method, url[len(self.api_url):], kwargs, execute)
+
+    def _send(self, method, url, authenticate, body_position, replayable, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if not authenticate:
+            return self._http_request(method, url, body_position, kwargs)
+
+        access_token = self._ensure_access_token()
+        response = self._http_request(method, url, body_position, kwargs)
+        if response.status_code == 401 and replayable:
+            # The token was revoked or expired early, refresh it once and replay the request
+            self.token_manager.invalidate(access_token)
+            self._ensure_access_token()
+            response = self._http_request(method, url, body_position, kwargs)
+        return response
+
+    def _http_request(self, method, url, body_position, kwargs):
+        if body_position is not None:
+            kwargs['data'].seek(body_position)
+        return self.http.request(method, url, **kwargs)
+
+    def _ensure_access_token(self):
+        access_token = self.token_manager.get_access_token()
+        if access_token != self._access_token:
+            self.access_token = access_token
+        return access_token
 
     def connect(self):
+        refresh_token, _ = self._login()
+        self.token_manager.set_tokens(refresh_token=refresh_token)
+        return refresh_token
+
+    def get_access_token(self, refresh_token):
+        access_token = self._fetch_access_token(refresh_token)
+        self.token_manager.set_tokens(refresh_token=refresh_token)
+        self.access_token = access_token
+        return self.access_token
+
+    def _login(self):
         headers = {
             'X-Requested-With': 'XMLHttpRequest',
-            'Content-Type': APPLICATION_JSON
+            'Authorization': None
         }
-        payload = json.dumps(self.credentials)
-        response = requests.post(self.login_endpoint, headers=headers, data=payload)
+        payload = JsonBackend.dumps(self.credentials)
+        response = self._request('POST', self.login_endpoint, authenticate=False, idempotent=True,
+                                 headers=headers, data=payload)
 
         if response.status_code == 200:
-            return response.json().get('refreshToken')
+            tokens = _response_json(response)
+            return tokens.get('refreshToken'), tokens.get('token')
         else:
             raise requests.HTTPError(f"Login failed: {response.status_code} {response.text}")
 
-    def get_access_token(self, refresh_token):
+    def _fetch_access_token(self, refresh_token):
         headers = {
-            'Content-Type': APPLICATION_JSON,
             'Authorization': f'Bearer {refresh_token}'
         }
-        response = requests.get(self.token_endpoint, headers=headers)
+        response = self._request('GET', self.token_endpoint, authenticate=False, headers=headers)
 
         if response.status_code == 200:
-            token_data = response.json()
-            self.access_token = token_data.get('token')
-            return self.access_token
+            return _response_json(response).get('token')
         else:
             raise requests.HTTPError(f"Token refresh failed: {response.status_code} {response.text}")
 
     def model_exists(self, model_name, model_version):
-        export_model_url = f"{self.api_url}/treeNode/model/export/SIMPLE_VIEW/{model_name}/{model_version}"
-        headers = self._get_headers()
-
-        response = requests.get(export_model_url, headers=headers)
-        return response.status_code == 200
+        return self._export_model(model_name, model_version).status_code == 200
 
     def get_model(self, model_name, model_version):
-        export_model_url = f"{self.api_url}/treeNode/model/export/SIMPLE_VIEW/{model_name}/{model_version}"
-        headers = self._get_headers()
-
-        response = requests.get(export_model_url, headers=headers)
-        if response.status_code == 200:
-            return response.json()
+        model_export = self._export_model(model_name, model_version)
+        if model_export.status_code == 200:
+            return copy.deepcopy(model_export.model)
         else:
-            raise requests.HTTPError(f"Getting the model failed: {response.status_code} {response.text}")
+            raise requests.HTTPError(f"Getting the model failed: {model_export.status_code} {model_export.text}")
 
     def get_model_state(self, model_name, model_version):
+        model_export = self._export_model(model_name, model_version)
+        if model_export.status_code == 200:
+            return model_export.model.get('currentState')
+        else:
+            raise requests.HTTPError(f"Failed to get the model: {model_export.status_code} {model_export.text}")
+
+    def _export_model(self, model_name, model_version):
+        key = (model_name, str(model_version))
+        with self._model_cache_lock:
+            cached = self._model_cache.get(key)
+        if cached is not None and time.monotonic() - cached.fetched_at < self.model_cache_ttl:
+            return cached
+
         export_model_url = f"{self.api_url}/treeNode/model/export/SIMPLE_VIEW/{model_name}/{model_version}"
-        headers = self._get_headers()
+        headers = {}
+        if cached is not None and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        response = self._request('GET', export_model_url, headers=headers)
 
-        response = requests.get(export_model_url, headers=headers)
-        if response.status_code == 200:
-            return response.json().get('currentState')
+        if response.status_code == 304 and cached is not None:
+            model_export = cached._replace(fetched_at=time.monotonic())
         else:
-            raise requests.HTTPError(f"Failed to get the model: {response.status_code} {response.text}")
+            model_export = ModelExport(
+                status_code=response.status_code,
+                model=_response_json(response) if response.status_code == 200 else None,
+                text=response.text if response.status_code != 200 else None,
+                etag=response.headers.get('ETag'),
+                fetched_at=time.monotonic()
+            )
+
+        if self.model_cache_ttl > 0 and model_export.status_code in (200, 404):
+            with self._model_cache_lock:
+                self._model_cache[key] = model_export
+        return model_export
+
+    def invalidate_model(self, model_name, model_version):
+        with self._model_cache_lock:
+            self._model_cache.pop((model_name, str(model_version)), None)
+        self.invalidate_searches(model_name, model_version)
+
+    def invalidate_searches(self, model_name=None, model_version=None):
+        # Called whenever entities of the model are written, so cached searches never hide the change
+        if self.search_cache is not None:
+            self.search_cache.invalidate(model_name, model_version)
 
     def unlock_model(self, model_name, model_version):
         unlock_model_url = f"{self.api_url}/treeNode/model/{model_name}/{model_version}/unlock"
-        headers = self._get_headers()
-
-        response = requests.put(unlock_model_url, headers=headers)
+        response = self._request('PUT', unlock_model_url)
+        self.invalidate_model(model_name, model_version)
         if response.status_code == 200:
             print('Model unlocked')
         else:
@@ -112,9 +596,8 @@ class CyodaSession:
 
     def lock_model(self, model_name, model_version):
         lock_model_url = f"{self.api_url}/treeNode/model/{model_name}/{model_version}/lock"
-        headers = self._get_headers()
-
-        response = requests.put(lock_model_url, headers=headers)
+        response = self._request('PUT', lock_model_url)
+        self.invalidate_model(model_name, model_version)
         if response.status_code == 200:
             print('Model locked')
         else:
@@ -122,38 +605,99 @@ class CyodaSession:
 
     def delete_model(self, model_name, model_version):
         model_url = f"{self.api_url}/treeNode/model/{model_name}/{model_version}"
-        headers = self._get_headers()
-
-        response = requests.delete(model_url, headers=headers)
+        response = self._request('DELETE', model_url)
+        self.invalidate_model(model_name, model_version)
         if response.status_code == 200:
             print('Model deleted')
         else:
             raise requests.HTTPError(f"Deletion of the model failed: {response.status_code} {response.text}")
 
-    def delete_all_entities(self, model_name, model_version):
+    def delete_all_entities(self, model_name, model_version, page_size=1000, transaction_size=1000, condition=None):
+        # With a condition only the matching entities are removed, still in one server-side call
         delete_entities_url = f"{self.api_url}/entity/TREE/{model_name}/{model_version}"
-        headers = self._get_headers()
-
         params = {
-            'pageSize': '1000',
-            'transactionSize': '1000'
+            'pageSize': f"{page_size}",
+            'transactionSize': f"{transaction_size}"
         }
-        response = requests.delete(delete_entities_url, headers=headers, params=params)
+        if condition is None:
+            response = self._request('DELETE', delete_entities_url, params=params)
+        else:
+            response = self._request('DELETE', delete_entities_url, params=params, data=JsonBackend.dumps(condition))
+        self.invalidate_searches(model_name, model_version)
 
         if response.status_code == 200:
-            return self.calculate_total_entities_removed(response.json())
+            return self.calculate_total_entities_removed(_response_json(response))
         else:
             raise requests.HTTPError(f"Deletion failed: {response.status_code} {response.text}")
 
+    def delete_entity(self, entity_id, missing_ok=False):
+        delete_entity_url = f"{self.api_url}/entity/TREE/{entity_id}"
+        response = self._request('DELETE', delete_entity_url)
+        # The model of the entity is not known here
+        self.invalidate_searches()
+
+        if response.status_code == 200:
+            return _response_json(response)
+        elif response.status_code == 404 and missing_ok:
+            return None
+        else:
+            raise requests.HTTPError(f"Deletion of entity {entity_id} failed: {response.status_code} {response.text}")
+
     def calculate_total_entities_removed(self, data):
         total_entities_removed = 0
         for entry in data:
             total_entities_removed += entry['deleteResult']['numberOfEntititesRemoved']
         return total_entities_removed
 
-    def reset_model(self, model_name, model_version, file_path):
+    def reset_model(self, model_name, model_version, file_path, compress=False, progress=None, wipe=WIPE_NEVER):
+        # Only does what the difference between the sample's structure and the existing model needs: nothing
+        # when the model already covers the sample, a merge of the sample into the unlocked model when it only
+        # adds paths or types, and the delete-everything cycle only when wipe allows it ('if_needed') or asks
+        # for it ('always'). Returns 'created', 'unchanged', 'extended' or 'wiped'.
         print(f"Resetting model '{model_name}' version {model_version}")
+        if wipe not in (WIPE_NEVER, WIPE_IF_NEEDED, WIPE_ALWAYS):
+            raise ValueError(f"wipe must be one of '{WIPE_NEVER}', '{WIPE_IF_NEEDED}' or '{WIPE_ALWAYS}', not {wipe}")
+
+        if wipe == WIPE_ALWAYS:
+            self._wipe_model(model_name, model_version)
+            self._derive_and_lock(model_name, model_version, file_path, compress, progress)
+            return 'wiped'
 
+        if not self.model_exists(model_name, model_version):
+            print(f"Model {model_name} {model_version} doesn't exist. Nothing to delete.")
+            self._derive_and_lock(model_name, model_version, file_path, compress, progress)
+            return 'created'
+
+        sample_schema = infer_file_schema(file_path)
+        model_schema = export_schema(self.get_model(model_name, model_version))
+        additions = schema_additions(sample_schema, model_schema)
+        if not additions:
+            print(f"Model '{model_name}' version {model_version} already covers the sample "
+                  f"(schema {schema_fingerprint(model_schema)[:12]}), nothing to reset")
+            if self.get_model_state(model_name, model_version) != 'LOCKED':
+                self.lock_model(model_name, model_version)
+            return 'unchanged'
+
+        print(f"The sample adds {len(additions)} paths to the model: {', '.join(sorted(additions))}")
+        try:
+            if self.get_model_state(model_name, model_version) == 'LOCKED':
+                self.unlock_model(model_name, model_version)
+            self._derive_and_lock(model_name, model_version, file_path, compress, progress)
+            return 'extended'
+        except requests.HTTPError as e:
+            if wipe != WIPE_IF_NEEDED:
+                if self.get_model_state(model_name, model_version) != 'LOCKED':
+                    self.lock_model(model_name, model_version)
+                raise SchemaChangeError(
+                    f"Model '{model_name}' version {model_version} can not be extended in place: {e}. "
+                    f"Pass wipe='{WIPE_IF_NEEDED}' to delete all its entities and derive it again") from e
+            print(f"Extending the model in place failed, wiping it: {e}")
+
+        self._wipe_model(model_name, model_version)
+        self._derive_and_lock(model_name, model_version, file_path, compress, progress)
+        return 'wiped'
+
+    def _wipe_model(self, model_name, model_version):
         if self.model_exists(model_name, model_version):
             print(f"Deleting all data for model '{model_name}' version {model_version}")
             total_entities_deleted = self.delete_all_entities(model_name, model_version)
@@ -165,118 +709,273 @@ class CyodaSession:
         else:
             print(f"Model {model_name} {model_version} doesn't exist. Nothing to delete.")
 
-        with open(file_path, 'r') as file:
-            file_contents = json.load(file)
-
-        payload = json.dumps(file_contents)
-        model_id = self.derive_model_from_sample_data(model_name, model_version, payload)
+    def _derive_and_lock(self, model_name, model_version, file_path, compress, progress):
+        # The sample is sent as it is on disk, the server parses it anyway
+        model_id = self.derive_model_from_sample_data(model_name, model_version, Path(file_path), compress, progress)
         print(f"Model id = {model_id}")
         self.lock_model(model_name, model_version)
-        print('Model locked')
 
-    def derive_model_from_sample_data(self, model_name, model_version, payload):
+    def derive_model_from_sample_data(self, model_name, model_version, payload, compress=False, progress=None):
         import_model_url = f"{self.api_url}/treeNode/model/import/JSON/SAMPLE_DATA/{model_name}/{model_version}"
-        headers = self._get_headers()
-
-        response = requests.post(import_model_url, headers=headers, data=payload)
+        with _open_payload(payload, compress, progress) as data:
+            response = self._request('POST', import_model_url, data=data, headers=_payload_headers(data))
+        self.invalidate_model(model_name, model_version)
         if response.status_code == 200:
             return response.text
         else:
             raise requests.HTTPError(f"Save failed: {response.status_code} {response.text}")
 
-    def create_entity(self, model_name, model_version, json_payload):
+    def create_entity(self, model_name, model_version, json_payload, compress=False, progress=None):
         create_entity_url = f"{self.api_url}/entity/JSON/TREE/{model_name}/{model_version}"
-        headers = self._get_headers()
-
         params = {
             'transactionTimeoutMillis': '10000'
         }
 
-        response = requests.post(create_entity_url, headers=headers, params=params, data=json_payload)
+        with _open_payload(json_payload, compress, progress) as data:
+            response = self._request('POST', create_entity_url, params=params, data=data,
+                                     headers=_payload_headers(data))
+        self.invalidate_searches(model_name, model_version)
         if response.status_code == 200:
-            return response.json()[0]['entityIds'][0]
+            return _response_json(response)[0]['entityIds'][0]
         else:
             raise requests.HTTPError(f"Save failed: {response.status_code} {response.text}")
 
-    def _get_headers(self):
-        return {
-            'Content-Type': APPLICATION_JSON,
-            'Authorization': f'Bearer {self.access_token}'
+    def create_entities(
+            self,
+            model_name,
+            model_version,
+            records,
+            batch_size=DEFAULT_BATCH_SIZE,
+            batch_bytes=DEFAULT_BATCH_BYTES,
+            max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+            transaction_timeout_millis=10000
+    ):
+        create_entities_url = f"{self.api_url}/entity/JSON/TREE/{model_name}/{model_version}"
+        params = {
+            'transactionTimeoutMillis': f"{transaction_timeout_millis}"
         }
 
-    def get_all_entities(self, model_name, model_version, page_size, page_number):
-        url = f"{self.api_url}/entity/TREE/{model_name}/{model_version}"
+        result = BulkCreateResult()
+        in_flight = {}
+        next_index = 0
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            for batch_number, batch in enumerate(_batch_records(records, batch_size, batch_bytes)):
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._collect_batch(result, future, *in_flight.pop(future))
+
+                payload = b'[' + b','.join(batch) + b']'
+                future = executor.submit(self._post_entities, create_entities_url, params, payload)
+                in_flight[future] = (batch_number, next_index, len(batch))
+                next_index += len(batch)
+
+            for future in in_flight:
+                self._collect_batch(result, future, *in_flight[future])
+        self.invalidate_searches(model_name, model_version)
+        return result
+
+    def _post_entities(self, url, params, payload):
+        response = self._request('POST', url, params=params, data=payload)
+        if response.status_code == 200:
+            return [entity_id for transaction in _response_json(response) for entity_id in transaction['entityIds']]
+        else:
+            raise requests.HTTPError(f"Save failed: {response.status_code} {response.text}")
 
-        headers = self._get_headers()
+    @staticmethod
+    def _collect_batch(result, future, batch_number, first_index, size):
+        try:
+            ids = future.result()
+        except Exception as e:
+            result.failures.append(BatchFailure(batch_number, first_index, size, e))
+            ids = []
+        ids = ids[:size] + [None] * (size - len(ids))
+        result._set_ids(first_index, ids)
 
+    def _get_headers(self):
+        return dict(self.http.headers)
+
+    def get_all_entities(self, model_name, model_version, page_size, page_number):
+        url = f"{self.api_url}/entity/TREE/{model_name}/{model_version}"
         params = {
             'pageSize': f"{page_size}",
             'pageNumber': f"{page_number}"
         }
 
-        response = requests.get(url, headers=headers, params=params)
+        response = self._request('GET', url, params=params)
         if response.status_code == 200:
-            return response.json()
+            return _response_json(response)
         else:
             raise requests.HTTPError(f"Get all entities failed: {response.status_code} {response.text}")
 
+    def iter_entities(self, model_name, model_version, page_size=DEFAULT_PAGE_SIZE, prefetch=DEFAULT_PREFETCH_PAGES):
+        def fetch_page(size, number):
+            return self.get_all_entities(model_name, model_version, size, number)
+
+        return _iter_pages(fetch_page, page_size, prefetch, self.first_page_number)
+
+    def entity_columns(
+            self,
+            model_name,
+            model_version,
+            columns,
+            output='numpy',
+            explode=False,
+            page_size=DEFAULT_PAGE_SIZE,
+            prefetch=DEFAULT_PREFETCH_PAGES
+    ):
+        # columns maps names to jsonPaths such as '$.category' or '$.laureates[*].surname'
+        builder = ColumnarBuilder(columns, output, explode)
+        builder.add_records(self.iter_entities(model_name, model_version, page_size, prefetch))
+        return builder.result()
+
     def create_snapshot_search(self, model_name, model_version, condition):
         url = f"{self.api_url}/treeNode/search/snapshot/{model_name}/{model_version}"
-        headers = self._get_headers()
-
-        response = requests.post(url, headers=headers, data=json.dumps(condition))
+        # A repeated trigger only creates another snapshot of the same search
+        response = self._request('POST', url, idempotent=True, data=JsonBackend.dumps(condition))
         if response.status_code == 200:
-            return response.json()
+            return _response_json(response)
         else:
             raise requests.HTTPError(f"Snapshot search trigger failed: {response.status_code} {response.text}")
 
     def get_snapshot_status(self, snapshot_id):
         url = f"{self.api_url}/treeNode/search/snapshot/{snapshot_id}/status"
-        headers = self._get_headers()
-
-        response = requests.get(url, headers=headers)
+        response = self._request('GET', url)
         if response.status_code == 200:
-            return response.json()
+            return _response_json(response)
         else:
             raise requests.HTTPError(f"Snapshot search status check failed: {response.status_code} {response.text}")
 
-    def wait_for_search_completion(self, snapshot_id, timeout=5, interval=10):
-        start_time = time.time()
-
-        while True:
-            status_response = self.get_snapshot_status(snapshot_id)
+    def wait_for_search_completion(self, snapshot_id, timeout=DEFAULT_SEARCH_TIMEOUT, interval=None, polling=None):
+        if interval is not None:
+            polling = PollingStrategy(initial_interval=interval / 1000)
+        return self.wait_for_many([snapshot_id], timeout, polling)[snapshot_id]
+
+    def wait_for_many(self, snapshot_ids, timeout=DEFAULT_SEARCH_TIMEOUT, polling=None, return_exceptions=False):
+        # Polls all snapshots from one schedule ordered by when each one is next due, so waiting on
+        # many searches costs one status call per snapshot per interval and no extra threads
+        polling = polling or self.polling
+        start_time = time.monotonic()
+        deadline = start_time + timeout
+
+        snapshot_ids = list(dict.fromkeys(snapshot_ids))
+        intervals = {snapshot_id: polling.initial_interval for snapshot_id in snapshot_ids}
+        entities_counts = {}
+        results = {}
+        due = [(start_time, snapshot_id) for snapshot_id in snapshot_ids]
+        heapq.heapify(due)
+
+        while due:
+            due_time, snapshot_id = heapq.heappop(due)
+            delay = due_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                status_response = self.get_snapshot_status(snapshot_id)
+            except Exception as e:
+                # An expired or unknown snapshot only fails its own entry, as with asyncio.gather
+                if not return_exceptions:
+                    raise
+                results[snapshot_id] = e
+                continue
             status = status_response.get("snapshotStatus")
 
+            error = None
             if status == "SUCCESSFUL":
-                return status_response
+                results[snapshot_id] = status_response
+                continue
             elif status != "RUNNING":
-                raise requests.HTTPError(f"Snapshot search failed: {json.dumps(status_response, indent=4)}")
+                error = requests.HTTPError(f"Snapshot search failed: {json.dumps(status_response, indent=4)}")
+            elif time.monotonic() >= deadline:
+                error = TimeoutError(f"Timeout exceeded after {timeout} seconds")
 
-            elapsed_time = time.time() - start_time
-            if elapsed_time > timeout:
-                raise TimeoutError(f"Timeout exceeded after {timeout} seconds")
+            if error is not None:
+                if not return_exceptions:
+                    raise error
+                results[snapshot_id] = error
+                continue
 
-            time.sleep(interval / 1000)
+            entities_count = status_response.get("entitiesCount")
+            progressed = entities_count is not None and entities_count > entities_counts.get(snapshot_id, entities_count)
+            entities_counts[snapshot_id] = entities_count
+
+            now = time.monotonic()
+            intervals[snapshot_id] = polling.next_interval(intervals[snapshot_id], now - start_time, progressed)
+            next_poll = min(now + polling.jittered(intervals[snapshot_id]), deadline)
+            heapq.heappush(due, (next_poll, snapshot_id))
+
+        return {snapshot_id: results[snapshot_id] for snapshot_id in snapshot_ids}
 
     def get_search_result(self, snapshot_id, page_size, page_number):
         url = f"{self.api_url}/treeNode/search/snapshot/{snapshot_id}"
-        headers = self._get_headers()
-
         params = {
             'pageSize': f"{page_size}",
             'pageNumber': f"{page_number}"
         }
 
-        response = requests.get(url, headers=headers, params=params)
+        if self.search_cache is not None:
+            content = self.search_cache.get_page(snapshot_id, page_size, page_number)
+            if content is not None:
+                return JsonBackend.loads(content)
+
+        response = self._request('GET', url, params=params)
         if response.status_code == 200:
-            return response.json()
+            if self.search_cache is not None:
+                self.search_cache.put_page(snapshot_id, page_size, page_number, response.content)
+            return _response_json(response)
         else:
             raise requests.HTTPError(f"Get search result failed: {response.status_code} {response.text}")
 
-    def search_entities(self, model_name, model_version, condition):
+    def iter_search_results(self, snapshot_id, page_size=DEFAULT_PAGE_SIZE, prefetch=DEFAULT_PREFETCH_PAGES):
+        def fetch_page(size, number):
+            return self.get_search_result(snapshot_id, size, number)
+
+        return _iter_pages(fetch_page, page_size, prefetch, self.first_page_number)
+
+    def read_search_results(
+            self,
+            snapshot_id,
+            page_size=DEFAULT_PAGE_SIZE,
+            entities_count=None,
+            parallelism=DEFAULT_PARALLELISM,
+            ordered=True
+    ):
+        if entities_count is None:
+            entities_count = self.get_snapshot_status(snapshot_id).get('entitiesCount', 0)
+        page_count = -(-entities_count // page_size)
+
+        def fetch_page(size, number):
+            return self.get_search_result(snapshot_id, size, number)
+
+        page_numbers = range(self.first_page_number, self.first_page_number + page_count)
+        return _fan_out_pages(fetch_page, page_size, page_numbers, parallelism, ordered)
+
+    def search_columns(
+            self,
+            snapshot_id,
+            columns,
+            output='numpy',
+            explode=False,
+            page_size=DEFAULT_PAGE_SIZE,
+            parallelism=DEFAULT_PARALLELISM
+    ):
+        # Row order does not matter for columnar analysis, so pages are consumed as they arrive
+        builder = ColumnarBuilder(columns, output, explode)
+        builder.add_records(self.read_search_results(snapshot_id, page_size, parallelism=parallelism, ordered=False))
+        return builder.result()
+
+    def search_entities(self, model_name, model_version, condition, use_cache=True):
+        if self.search_cache is not None and use_cache:
+            status_response = self.search_cache.lookup(model_name, model_version, condition)
+            if status_response is not None:
+                return status_response
+
         snapshot_id = self.create_snapshot_search(model_name, model_version, condition)
         status_response = self.wait_for_search_completion(snapshot_id)
         status_response['snapshotId'] = snapshot_id
+        if self.search_cache is not None:
+            self.search_cache.store(model_name, model_version, condition, status_response)
         return status_response
 
     def convert_to_local_time(self, iso_string):
@@ -0,0 +1,182 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future, wait
+
+from CyodaSession import DEFAULT_BATCH_BYTES, DEFAULT_BATCH_SIZE, DEFAULT_MAX_IN_FLIGHT, _encode_record
+
+DEFAULT_MAX_AGE = 1.0
+DEFAULT_QUEUE_SIZE = 10000
+
+_CLOSE = object()
+
+
+class _FlushRequest:
+    def __init__(self):
+        self.submitted = threading.Event()
+        self.batches = ()
+
+
+class EntityWriter:
+    def __init__(
+            self,
+            session,
+            model_name,
+            model_version,
+            batch_size=DEFAULT_BATCH_SIZE,
+            batch_bytes=DEFAULT_BATCH_BYTES,
+            max_age=DEFAULT_MAX_AGE,
+            max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+            queue_size=DEFAULT_QUEUE_SIZE,
+            transaction_timeout_millis=10000
+    ):
+        # Write-behind buffer in front of the bulk create endpoint. put() queues a record and returns a
+        # future for its entity id; a background thread coalesces queued records into batches that are sent
+        # once they reach batch_size records or batch_bytes bytes, or when the oldest has waited max_age
+        # seconds. At most max_in_flight batches are sent at a time. When the server falls behind, the
+        # bounded queue fills up and put() blocks, which slows the producers down to the server's pace.
+        self.session = session
+        self.model_name = model_name
+        self.model_version = model_version
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.max_age = max_age
+        self.url = f"{session.api_url}/entity/JSON/TREE/{model_name}/{model_version}"
+        self.params = {
+            'transactionTimeoutMillis': f"{transaction_timeout_millis}"
+        }
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._batches = queue.Queue()
+        self._slots = threading.Semaphore(max_in_flight)
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        self._closed = False
+        self._close_lock = threading.Lock()
+
+        # Own daemon threads rather than an executor, which stops accepting work before atexit handlers run
+        self._worker = threading.Thread(target=self._run, name=f"EntityWriter-{model_name}", daemon=True)
+        self._senders = [threading.Thread(target=self._send, name=f"EntityWriter-{model_name}-{number}", daemon=True)
+                         for number in range(max_in_flight)]
+        self._worker.start()
+        for sender in self._senders:
+            sender.start()
+        # Records still buffered when the interpreter exits are written before it does
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def put(self, record, timeout=None):
+        # Blocks while the queue is full; raises queue.Full when timeout expires first
+        if self._closed:
+            raise RuntimeError("The entity writer is closed")
+        future = Future()
+        self._queue.put((_encode_record(record), future), timeout=timeout)
+        return future
+
+    def flush(self, timeout=None):
+        # Sends whatever is buffered and waits until every record put before this call has been written
+        if self._closed:
+            return
+        request = _FlushRequest()
+        self._queue.put(request)
+        request.submitted.wait()
+        wait(request.batches, timeout=timeout)
+
+    def close(self):
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put(_CLOSE)
+        self._worker.join()
+        for _ in self._senders:
+            self._batches.put(_CLOSE)
+        for sender in self._senders:
+            sender.join()
+
+    def _run(self):
+        batch = []
+        batch_length = 0
+        batch_started = None
+        while True:
+            timeout = None
+            if batch:
+                timeout = max(0.0, self.max_age - (time.monotonic() - batch_started))
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is None or item is _CLOSE or isinstance(item, _FlushRequest):
+                # The oldest record reached max_age, or everything buffered is to be sent now
+                if batch:
+                    self._submit(batch)
+                    batch, batch_length = [], 0
+                if item is _CLOSE:
+                    return
+                if item is not None:
+                    with self._in_flight_lock:
+                        item.batches = tuple(self._in_flight)
+                    item.submitted.set()
+                continue
+
+            encoded, future = item
+            if batch and (len(batch) >= self.batch_size or batch_length + len(encoded) + 1 > self.batch_bytes):
+                self._submit(batch)
+                batch, batch_length = [], 0
+            if not batch:
+                batch_started = time.monotonic()
+            batch.append(item)
+            batch_length += len(encoded) + 1
+            if len(batch) >= self.batch_size:
+                self._submit(batch)
+                batch, batch_length = [], 0
+
+    def _submit(self, batch):
+        # Waiting for a free slot here stops the worker from taking more records off the queue
+        self._slots.acquire()
+        payload = b'[' + b','.join(encoded for encoded, _ in batch) + b']'
+        done = Future()
+        with self._in_flight_lock:
+            self._in_flight.add(done)
+        self._batches.put((payload, [future for _, future in batch], done))
+
+    def _send(self):
+        while True:
+            item = self._batches.get()
+            if item is _CLOSE:
+                return
+            payload, futures, done = item
+            try:
+                self._resolve(futures, payload)
+            finally:
+                self.session.invalidate_searches(self.model_name, self.model_version)
+                with self._in_flight_lock:
+                    self._in_flight.discard(done)
+                self._slots.release()
+                done.set_result(None)
+
+    def _resolve(self, futures, payload):
+        try:
+            ids = self.session._post_entities(self.url, self.params, payload)
+            if len(ids) != len(futures):
+                raise RuntimeError(f"Expected {len(futures)} entity ids for the batch, got {len(ids)}")
+        except Exception as e:
+            for future in futures:
+                if not future.cancelled():
+                    future.set_exception(e)
+            return
+        for future, entity_id in zip(futures, ids):
+            if not future.cancelled():
+                future.set_result(entity_id)
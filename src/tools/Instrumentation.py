@@ -0,0 +1,246 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import bisect
+import json
+import mmap
+import re
+import threading
+import time
+from collections import namedtuple
+from contextlib import nullcontext
+
+# Seconds, the same defaults the Prometheus client libraries use
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Calls are reported by endpoint template rather than raw URL, so that metrics do not grow a series per
+# entity, snapshot or model. Templates are matched in order against the path below the API URL.
+ENDPOINT_TEMPLATES = [
+    ('/auth/login', r'/auth/login'),
+    ('/auth/token', r'/auth/token'),
+    ('/treeNode/model/export/SIMPLE_VIEW/{model}/{version}', r'/treeNode/model/export/SIMPLE_VIEW/[^/]+/[^/]+'),
+    ('/treeNode/model/import/JSON/SAMPLE_DATA/{model}/{version}',
+     r'/treeNode/model/import/JSON/SAMPLE_DATA/[^/]+/[^/]+'),
+    ('/treeNode/model/{model}/{version}/lock', r'/treeNode/model/[^/]+/[^/]+/lock'),
+    ('/treeNode/model/{model}/{version}/unlock', r'/treeNode/model/[^/]+/[^/]+/unlock'),
+    ('/treeNode/model/{model}/{version}', r'/treeNode/model/[^/]+/[^/]+'),
+    ('/entity/JSON/TREE/{model}/{version}', r'/entity/JSON/TREE/[^/]+/[^/]+'),
+    ('/entity/TREE/{model}/{version}', r'/entity/TREE/[^/]+/[^/]+'),
+    ('/entity/TREE/{id}', r'/entity/TREE/[^/]+'),
+    ('/treeNode/search/snapshot/{id}/status', r'/treeNode/search/snapshot/[^/]+/status'),
+    ('/treeNode/search/snapshot/{model}/{version}', r'/treeNode/search/snapshot/[^/]+/[^/]+'),
+    ('/treeNode/search/snapshot/{id}', r'/treeNode/search/snapshot/[^/]+'),
+]
+_COMPILED_TEMPLATES = [(template, re.compile(pattern)) for template, pattern in ENDPOINT_TEMPLATES]
+_ID_SEGMENT = re.compile(r'/(?:[0-9a-fA-F]{8}-[0-9a-fA-F-]{27}|\d+)(?=/|$)')
+
+RequestEvent = namedtuple('RequestEvent', [
+    'method', 'endpoint', 'status_code', 'latency', 'bytes_sent', 'bytes_received', 'retries', 'pool_wait', 'error'
+])
+
+
+def endpoint_template(path):
+    path = path.split('?', 1)[0]
+    for template, pattern in _COMPILED_TEMPLATES:
+        if pattern.fullmatch(path):
+            return template
+    return _ID_SEGMENT.sub('/{id}', path)
+
+
+class RequestStats:
+    # Filled in by Resilience.execute while a call is instrumented
+    __slots__ = ('retries', 'pool_wait')
+
+    def __init__(self):
+        self.retries = 0
+        self.pool_wait = 0.0
+
+
+class Instrumentation:
+    def __init__(self, hooks=(), span_factory=None):
+        # hooks are called with a RequestEvent once per logical call, after any retries.
+        # span_factory(name, attributes=...) returns a context manager, such as an OpenTelemetry
+        # tracer's start_as_current_span; the span it yields receives the outcome through set_attribute.
+        self.hooks = list(hooks)
+        self.span_factory = span_factory
+
+    @property
+    def enabled(self):
+        return bool(self.hooks) or self.span_factory is not None
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def observe(self, method, path, request_kwargs, execute):
+        # execute(stats) performs the call; stats collects the retries and the time spent waiting for a slot
+        endpoint = endpoint_template(path)
+        data = request_kwargs.get('data')
+        stats = RequestStats()
+        if self.span_factory is not None:
+            span_context = self.span_factory(f"{method} {endpoint}",
+                                             attributes={'http.method': method, 'cyoda.endpoint': endpoint})
+        else:
+            span_context = nullcontext()
+
+        with span_context as span:
+            start = time.perf_counter()
+            try:
+                response = execute(stats)
+            except Exception as e:
+                self._emit(span, RequestEvent(method, endpoint, None, time.perf_counter() - start,
+                                              _payload_length(data), 0, stats.retries, stats.pool_wait, e))
+                raise
+            self._emit(span, RequestEvent(method, endpoint, response.status_code, time.perf_counter() - start,
+                                          _bytes_sent(response, data),
+                                          _bytes_received(response, request_kwargs.get('stream', False)),
+                                          stats.retries, stats.pool_wait, None))
+        return response
+
+    def _emit(self, span, event):
+        if span is not None and hasattr(span, 'set_attribute'):
+            if event.status_code is not None:
+                span.set_attribute('http.status_code', event.status_code)
+            span.set_attribute('cyoda.retries', event.retries)
+            span.set_attribute('cyoda.pool_wait', event.pool_wait)
+            span.set_attribute('cyoda.bytes_sent', event.bytes_sent)
+            span.set_attribute('cyoda.bytes_received', event.bytes_received)
+        for hook in self.hooks:
+            hook(event)
+
+
+def _payload_length(data):
+    if isinstance(data, (bytes, bytearray, mmap.mmap)):
+        return len(data)
+    if isinstance(data, str):
+        return len(data.encode('utf-8'))
+    return 0
+
+
+def _bytes_sent(response, data):
+    request = getattr(response, 'request', None)
+    content_length = request.headers.get('Content-Length') if request is not None else None
+    return int(content_length) if content_length else _payload_length(data)
+
+
+def _bytes_received(response, stream):
+    content_length = response.headers.get('Content-Length')
+    if content_length:
+        return int(content_length)
+    # Without a length header only an already read body can be measured, a streamed one is left untouched
+    return 0 if stream else len(response.content)
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class EndpointMetrics:
+    def __init__(self, buckets):
+        self.latency = LatencyHistogram(buckets)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.pool_wait = 0.0
+        self.errors = 0
+
+
+class MetricsRecorder:
+    # A hook that aggregates request events per (method, endpoint, status)
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS, namespace='cyoda'):
+        self.buckets = tuple(buckets)
+        self.namespace = namespace
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        status = str(event.status_code) if event.status_code is not None else type(event.error).__name__
+        key = (event.method, event.endpoint, status)
+        with self._lock:
+            metrics = self._metrics.get(key)
+            if metrics is None:
+                metrics = self._metrics[key] = EndpointMetrics(self.buckets)
+            metrics.latency.observe(event.latency)
+            metrics.bytes_sent += event.bytes_sent
+            metrics.bytes_received += event.bytes_received
+            metrics.retries += event.retries
+            metrics.pool_wait += event.pool_wait
+            if event.error is not None or event.status_code >= 400:
+                metrics.errors += 1
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                {
+                    'method': method,
+                    'endpoint': endpoint,
+                    'status': status,
+                    'count': metrics.latency.count,
+                    'errors': metrics.errors,
+                    'latency': {
+                        'sum': metrics.latency.sum,
+                        'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'],
+                                            metrics.latency.cumulative_counts()))
+                    },
+                    'bytes_sent': metrics.bytes_sent,
+                    'bytes_received': metrics.bytes_received,
+                    'retries': metrics.retries,
+                    'pool_wait': metrics.pool_wait
+                }
+                for (method, endpoint, status), metrics in sorted(self._metrics.items())
+            ]
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self):
+        name = self.namespace + '_request'
+        entries = self.snapshot()
+        lines = [
+            f"# HELP {name}_duration_seconds Latency of Cyoda API calls including retries",
+            f"# TYPE {name}_duration_seconds histogram",
+        ]
+        for entry in entries:
+            labels = _labels(entry)
+            for bound, count in entry['latency']['buckets'].items():
+                lines.append(f'{name}_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f"{name}_duration_seconds_sum{{{labels}}} {entry['latency']['sum']}")
+            lines.append(f"{name}_duration_seconds_count{{{labels}}} {entry['count']}")
+
+        counters = [
+            ('errors', 'errors_total', 'Failed Cyoda API calls'),
+            ('bytes_sent', 'sent_bytes_total', 'Request body bytes sent'),
+            ('bytes_received', 'received_bytes_total', 'Response body bytes received'),
+            ('retries', 'retries_total', 'Repeated attempts of Cyoda API calls'),
+            ('pool_wait', 'pool_wait_seconds_total', 'Time spent waiting for a concurrency slot'),
+        ]
+        for field, suffix, description in counters:
+            lines.append(f"# HELP {name}_{suffix} {description}")
+            lines.append(f"# TYPE {name}_{suffix} counter")
+            for entry in entries:
+                lines.append(f"{name}_{suffix}{{{_labels(entry)}}} {entry[field]}")
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(entry):
+    return f'method="{entry["method"]}",endpoint="{entry["endpoint"]}",status="{entry["status"]}"'
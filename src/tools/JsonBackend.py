@@ -0,0 +1,48 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import json
+
+try:
+    import orjson
+except ImportError:  # optional, the standard library is used when it is not installed
+    orjson = None
+
+# Encoding always produces UTF-8 bytes and decoding accepts bytes or str, whichever backend is active
+
+
+def _stdlib_dumps(value):
+    return json.dumps(value).encode('utf-8')
+
+
+def _stdlib_loads(data):
+    return json.loads(data)
+
+
+BACKENDS = {'json': (_stdlib_dumps, _stdlib_loads)}
+if orjson is not None:
+    BACKENDS['orjson'] = (orjson.dumps, orjson.loads)
+
+backend = None
+_dumps = None
+_loads = None
+
+
+def use_backend(name):
+    global backend, _dumps, _loads
+    if name not in BACKENDS:
+        raise ValueError(f"JSON backend '{name}' is not available, choose one of {sorted(BACKENDS)}")
+    backend = name
+    _dumps, _loads = BACKENDS[name]
+
+
+use_backend('orjson' if orjson is not None else 'json')
+
+
+def dumps(value):
+    return _dumps(value)
+
+
+def loads(data):
+    return _loads(data)
@@ -0,0 +1,149 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import hashlib
+import json
+
+import JsonBackend
+
+try:
+    import ijson
+except ImportError:  # optional, without it infer_file_schema parses the whole sample in memory
+    ijson = None
+
+# A schema maps the jsonPath of every leaf value, such as '$.laureates[*].surname', to the set of type
+# families seen there. Values do not matter, only structure. Numeric widths are folded into one family so that
+# a sample's 1 and the model's LONG compare equal.
+TYPE_FAMILIES = {
+    'BYTE': 'INTEGER',
+    'SHORT': 'INTEGER',
+    'INT': 'INTEGER',
+    'INTEGER': 'INTEGER',
+    'LONG': 'INTEGER',
+    'BIG_INTEGER': 'INTEGER',
+    'FLOAT': 'DECIMAL',
+    'DOUBLE': 'DECIMAL',
+    'BIG_DECIMAL': 'DECIMAL',
+    'CHARACTER': 'STRING',
+    'STRING': 'STRING',
+    'BOOLEAN': 'BOOLEAN',
+    'NULL': 'NULL',
+}
+# Entries of a SIMPLE_VIEW node that only say a field holds a nested object or array
+STRUCTURAL_TYPES = frozenset(['OBJECT', 'ARRAY', 'ARRAY_ELEMENT', 'LIST'])
+
+
+class SchemaChangeError(Exception):
+    pass
+
+
+def type_family(type_name):
+    type_name = str(type_name).strip().upper()
+    return TYPE_FAMILIES.get(type_name, type_name)
+
+
+def value_type_family(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'BOOLEAN'
+    if isinstance(value, int):
+        return 'INTEGER'
+    if isinstance(value, float):
+        return 'DECIMAL'
+    return 'STRING'
+
+
+def infer_schema(sample):
+    schema = {}
+
+    def visit(path, value):
+        if isinstance(value, dict):
+            for key, child in value.items():
+                visit(f"{path}.{key}", child)
+        elif isinstance(value, list):
+            for child in value:
+                visit(f"{path}[*]", child)
+        else:
+            schema.setdefault(path, set()).add(value_type_family(value))
+
+    visit('$', sample)
+    return schema
+
+
+def infer_file_schema(file_path):
+    # The schema of a sample file. With ijson installed the file is parsed as a stream of events, so memory
+    # stays flat however large the sample is; without it the whole sample is loaded and parsed first, which
+    # dominates a reset for samples of hundreds of MB.
+    if ijson is None:
+        with open(file_path, 'rb') as file:
+            return infer_schema(JsonBackend.loads(file.read()))
+
+    schema = {}
+    containers = []  # (path, is_array) of every open object and array
+    key_path = '$'
+    with open(file_path, 'rb') as file:
+        for event, value in ijson.basic_parse(file, use_float=True):
+            if event == 'map_key':
+                key_path = f"{containers[-1][0]}.{value}"
+                continue
+            if event in ('end_map', 'end_array'):
+                containers.pop()
+                continue
+            if not containers:
+                path = '$'
+            elif containers[-1][1]:
+                path = f"{containers[-1][0]}[*]"
+            else:
+                path = key_path
+            if event in ('start_map', 'start_array'):
+                containers.append((path, event == 'start_array'))
+            else:
+                schema.setdefault(path, set()).add(value_type_family(value))
+    return schema
+
+
+def export_schema(simple_view):
+    # The SIMPLE_VIEW export has one node per object path, mapping '.field' or '[*]' to a type or a list of types
+    model = simple_view.get('model', simple_view) if isinstance(simple_view, dict) else {}
+    schema = {}
+    for node_path, fields in model.items():
+        if not isinstance(fields, dict):
+            continue
+        for key, types in fields.items():
+            for type_name in _type_names(types):
+                family = type_family(type_name)
+                if family not in STRUCTURAL_TYPES:
+                    schema.setdefault(node_path + key, set()).add(family)
+    return schema
+
+
+def _type_names(types):
+    if isinstance(types, (list, tuple, set)):
+        return list(types)
+    types = str(types).strip()
+    if types.startswith('[') and types.endswith(']'):
+        return [name for name in types[1:-1].split(',') if name.strip()]
+    return [types]
+
+
+def schema_fingerprint(schema):
+    canonical = json.dumps({path: sorted(types) for path, types in schema.items()}, sort_keys=True,
+                           separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def schema_additions(sample_schema, model_schema):
+    # Paths and types of the sample that the model does not have yet. What the model has beyond the sample is
+    # not a change: a sample does not need to use every field to be accepted.
+    additions = {}
+    for path, types in sample_schema.items():
+        known = model_schema.get(path, set())
+        missing = types - known
+        if known:
+            # A null where the model already has a type is not a new shape
+            missing.discard('NULL')
+        if missing:
+            additions[path] = missing
+    return additions
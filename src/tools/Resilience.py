@@ -0,0 +1,219 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+# The server refused the request without processing it, so it can be repeated even when it is not idempotent
+REJECTED_STATUS_CODES = frozenset([429, 503])
+# The server may or may not have processed the request, so only idempotent requests are repeated
+SERVER_ERROR_STATUS_CODES = frozenset([500, 502, 504])
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = 'CLOSED'
+    OPEN = 'OPEN'
+    HALF_OPEN = 'HALF_OPEN'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        # While open every call fails fast; after reset_timeout a single trial call is let through.
+        # Returns True for that trial call, which must be settled with release_trial() whatever its outcome.
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._trial_in_flight):
+                raise CircuitOpenError(f"Circuit open after {self._failures} consecutive failures, failing fast")
+            if self.state == self.HALF_OPEN:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        # The trial ended without a verdict, such as a 429 or an error raised by send(), so the next call
+        # becomes the trial instead. After record_success or record_failure this changes nothing.
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class AdaptiveConcurrencyLimiter:
+    # AIMD: the number of requests allowed in flight grows by one per limit's worth of successful calls
+    # and is halved whenever the server pushes back
+    def __init__(self, initial_limit=16, min_limit=1, max_limit=64, decrease_factor=0.5):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            previous = int(self.limit)
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            if int(self.limit) > previous:
+                self._condition.notify()
+
+    def on_overload(self):
+        with self._condition:
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+
+
+class Resilience:
+    def __init__(
+            self,
+            max_retries=4,
+            backoff_base=0.2,
+            backoff_max=30.0,
+            circuit_breaker=None,
+            limiter=None
+    ):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.limiter = limiter or AdaptiveConcurrencyLimiter()
+
+    def execute(self, send, idempotent, limited=True, stats=None, max_retries=None, guarded=True):
+        # send() performs one attempt and returns the response. Failed attempts are repeated with
+        # exponential backoff and full jitter, or after the delay the server asked for in Retry-After.
+        # Calls made while another call holds a limiter slot (such as token refreshes) pass limited=False.
+        # When stats is given the number of retries and the time spent waiting for a slot are added to it.
+        # max_retries overrides the configured limit for this call, 0 for bodies that cannot be sent twice.
+        # Calls nested inside a guarded call (token refreshes again) pass guarded=False and bypass the circuit
+        # breaker: during a half-open trial the outer call holds the only slot, so a guarded refresh would fail
+        # fast and the trial could never succeed.
+        if max_retries is None:
+            max_retries = self.max_retries
+        limiter = self.limiter if limited else None
+        breaker = self.circuit_breaker if guarded else None
+        attempt = 0
+        while True:
+            trial = breaker is not None and breaker.before_call()
+            try:
+                if limiter is not None:
+                    if stats is None:
+                        limiter.acquire()
+                    else:
+                        wait_start = time.perf_counter()
+                        limiter.acquire()
+                        stats.pool_wait += time.perf_counter() - wait_start
+                try:
+                    response = send()
+                except requests.ConnectionError as e:
+                    # Nothing reached the server when the connection could not be established
+                    retryable = idempotent or isinstance(e, requests.ConnectTimeout) or _is_connect_failure(e)
+                    self._record_failure(breaker)
+                    if not retryable or attempt >= max_retries:
+                        raise
+                    response = None
+                except requests.Timeout:
+                    self._record_failure(breaker)
+                    if not idempotent or attempt >= max_retries:
+                        raise
+                    response = None
+                finally:
+                    if limiter is not None:
+                        limiter.release()
+
+                if response is not None:
+                    if response.status_code in REJECTED_STATUS_CODES:
+                        self.limiter.on_overload()
+                        if response.status_code == 503 and breaker is not None:
+                            breaker.record_failure()
+                        retryable = True
+                    elif response.status_code in SERVER_ERROR_STATUS_CODES:
+                        self._record_failure(breaker)
+                        retryable = idempotent
+                    else:
+                        if breaker is not None:
+                            breaker.record_success()
+                        self.limiter.on_success()
+                        return response
+
+                    if not retryable or attempt >= max_retries:
+                        return response
+            finally:
+                if trial:
+                    breaker.release_trial()
+
+            time.sleep(self._delay(attempt, response))
+            attempt += 1
+            if stats is not None:
+                stats.retries = attempt
+
+    def _record_failure(self, breaker):
+        if breaker is not None:
+            breaker.record_failure()
+        self.limiter.on_overload()
+
+    def _delay(self, attempt, response):
+        retry_after = _retry_after(response) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+def _is_connect_failure(error):
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,159 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+DEFAULT_EXPIRY_MARGIN = 60
+DEFAULT_PAGE_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def canonical_condition(condition):
+    # The same search written with keys or group members in another order gives the same text. AND/OR
+    # members are commutative, so they are sorted by their own canonical form.
+    def normalise(node):
+        if isinstance(node, dict):
+            normalised = {key: normalise(value) for key, value in node.items()}
+            if node.get('type') == 'group' and isinstance(normalised.get('conditions'), list):
+                normalised['conditions'] = sorted(normalised['conditions'], key=_canonical_text)
+            return normalised
+        if isinstance(node, list):
+            return [normalise(value) for value in node]
+        return node
+
+    return _canonical_text(normalise(condition))
+
+
+def _canonical_text(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def search_key(model_name, model_version, condition):
+    text = f"{model_name}\n{model_version}\n{canonical_condition(condition)}"
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _expiry_timestamp(status_response):
+    expiration_date = status_response.get('expirationDate')
+    if not expiration_date:
+        return None
+    try:
+        return datetime.fromisoformat(expiration_date).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class SearchCache:
+    def __init__(
+            self,
+            expiry_margin=DEFAULT_EXPIRY_MARGIN,
+            page_cache_dir=None,
+            page_cache_bytes=DEFAULT_PAGE_CACHE_BYTES
+    ):
+        # Completed searches are reused until expiry_margin seconds before their snapshot's expirationDate.
+        # With page_cache_dir, fetched result pages are kept on disk, least recently used evicted first
+        # once they take more than page_cache_bytes. Snapshots never change, so cached pages stay valid
+        # for as long as their snapshot id is in use.
+        self.expiry_margin = expiry_margin
+        self.page_cache_bytes = page_cache_bytes
+        self._searches = {}
+        self._lock = threading.Lock()
+
+        self.page_cache_dir = Path(page_cache_dir).expanduser() if page_cache_dir else None
+        self._pages = OrderedDict()
+        self._page_bytes = 0
+        if self.page_cache_dir is not None:
+            self.page_cache_dir.mkdir(parents=True, exist_ok=True)
+            self._load_page_index()
+
+    def lookup(self, model_name, model_version, condition):
+        key = search_key(model_name, model_version, condition)
+        with self._lock:
+            entry = self._searches.get(key)
+            if entry is None:
+                return None
+            if entry['expiresAt'] - self.expiry_margin <= time.time():
+                del self._searches[key]
+                return None
+            return copy.deepcopy(entry['statusResponse'])
+
+    def store(self, model_name, model_version, condition, status_response):
+        expires_at = _expiry_timestamp(status_response)
+        if expires_at is None:
+            # Without an expiration date there is no telling how long the snapshot lives
+            return
+        key = search_key(model_name, model_version, condition)
+        with self._lock:
+            self._searches[key] = {
+                'model': (model_name, str(model_version)),
+                'expiresAt': expires_at,
+                'statusResponse': copy.deepcopy(status_response)
+            }
+
+    def invalidate(self, model_name=None, model_version=None):
+        # Forgets the searches of one model version, or every search when no model is given
+        with self._lock:
+            if model_name is None:
+                self._searches.clear()
+                return
+            model = (model_name, str(model_version))
+            for key in [key for key, entry in self._searches.items() if entry['model'] == model]:
+                del self._searches[key]
+
+    def get_page(self, snapshot_id, page_size, page_number):
+        if self.page_cache_dir is None:
+            return None
+        name = self._page_name(snapshot_id, page_size, page_number)
+        with self._lock:
+            if name not in self._pages:
+                return None
+            self._pages.move_to_end(name)
+        try:
+            return (self.page_cache_dir / name).read_bytes()
+        except OSError:
+            with self._lock:
+                self._page_bytes -= self._pages.pop(name, 0)
+            return None
+
+    def put_page(self, snapshot_id, page_size, page_number, content):
+        if self.page_cache_dir is None or len(content) > self.page_cache_bytes:
+            return
+        name = self._page_name(snapshot_id, page_size, page_number)
+        path = self.page_cache_dir / name
+        temp_path = path.with_name(f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        temp_path.write_bytes(content)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._page_bytes += len(content) - self._pages.pop(name, 0)
+            self._pages[name] = len(content)
+            evicted = []
+            while self._page_bytes > self.page_cache_bytes and self._pages:
+                evicted_name, size = self._pages.popitem(last=False)
+                self._page_bytes -= size
+                evicted.append(evicted_name)
+        for evicted_name in evicted:
+            try:
+                os.remove(self.page_cache_dir / evicted_name)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _page_name(snapshot_id, page_size, page_number):
+        return f"{snapshot_id}-{page_size}-{page_number}.json"
+
+    def _load_page_index(self):
+        # Pages left by earlier runs are ordered by when they were last written
+        pages = [(entry.stat().st_mtime, entry.name, entry.stat().st_size)
+                 for entry in self.page_cache_dir.iterdir() if entry.suffix == '.json' and entry.is_file()]
+        for _, name, size in sorted(pages):
+            self._pages[name] = size
+            self._page_bytes += size
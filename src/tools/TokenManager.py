@@ -0,0 +1,138 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import base64
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+DEFAULT_REFRESH_MARGIN = 60
+DEFAULT_TOKEN_CACHE_PATH = '~/.cyoda/token_cache.json'
+
+
+def decode_token_expiry(token):
+    # Reads the `exp` claim of a JWT without verifying it, the server remains the authority on validity
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenCache:
+    _lock = threading.Lock()
+
+    def __init__(self, path=DEFAULT_TOKEN_CACHE_PATH):
+        self.path = Path(path).expanduser()
+
+    def load(self, key):
+        try:
+            with self.path.open('r') as file:
+                return json.load(file).get(key)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, refresh_token):
+        # Logins to several hosts at once share the file, so the read-modify-write is serialised
+        with self._lock:
+            self._store(key, refresh_token)
+
+    def _store(self, key, refresh_token):
+        try:
+            with self.path.open('r') as file:
+                tokens = json.load(file)
+        except (OSError, ValueError):
+            tokens = {}
+        if refresh_token:
+            tokens[key] = refresh_token
+        else:
+            tokens.pop(key, None)
+
+        # Written to a private temp file first and renamed, so the cache is never readable by others
+        # and never left half written
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        temp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as file:
+            json.dump(tokens, file)
+        os.replace(temp_path, self.path)
+
+
+class TokenManager:
+    def __init__(self, login, fetch_access_token, cache=None, cache_key=None, refresh_margin=DEFAULT_REFRESH_MARGIN):
+        # login() returns a new refresh token, or a (refresh token, access token) pair when the login response
+        # already carries one; fetch_access_token(refresh_token) exchanges a refresh token for an access token
+        self._login = login
+        self._fetch_access_token = fetch_access_token
+        self.cache = cache
+        self.cache_key = cache_key
+        self.refresh_margin = refresh_margin
+
+        self._lock = threading.Lock()
+        self._refresh_token = None
+        self._access_token = None
+        self._access_token_expiry = None
+
+    def set_tokens(self, refresh_token=None, access_token=None):
+        with self._lock:
+            if refresh_token:
+                self._refresh_token = refresh_token
+                self._store_refresh_token(refresh_token)
+            if access_token:
+                self._access_token = access_token
+                self._access_token_expiry = decode_token_expiry(access_token)
+
+    def get_access_token(self):
+        if self._is_valid(self._access_token, self._access_token_expiry):
+            return self._access_token
+
+        # Only the first of several concurrent callers refreshes, the others wait and reuse its token
+        with self._lock:
+            if not self._is_valid(self._access_token, self._access_token_expiry):
+                self._refresh()
+            return self._access_token
+
+    def invalidate(self, access_token):
+        with self._lock:
+            if self._access_token == access_token:
+                self._access_token = None
+                self._access_token_expiry = None
+
+    def _is_valid(self, token, expiry):
+        if not token:
+            return False
+        return expiry is None or expiry - self.refresh_margin > time.time()
+
+    def _refresh(self):
+        refresh_token = self._refresh_token
+        if not refresh_token and self.cache is not None:
+            refresh_token = self.cache.load(self.cache_key)
+
+        access_token = None
+        if refresh_token and self._is_valid(refresh_token, decode_token_expiry(refresh_token)):
+            try:
+                access_token = self._fetch_access_token(refresh_token)
+            except requests.HTTPError:
+                access_token = None
+
+        if not access_token:
+            refresh_token = self._login()
+            if isinstance(refresh_token, tuple):
+                refresh_token, access_token = refresh_token
+            self._store_refresh_token(refresh_token)
+            if not access_token:
+                access_token = self._fetch_access_token(refresh_token)
+
+        self._refresh_token = refresh_token
+        self._access_token = access_token
+        self._access_token_expiry = decode_token_expiry(access_token)
+
+    def _store_refresh_token(self, refresh_token):
+        if self.cache is not None and refresh_token != self.cache.load(self.cache_key):
+            self.cache.store(self.cache_key, refresh_token)
@@ -0,0 +1,227 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from CyodaSession import WIPE_ALWAYS, CyodaSession
+from cyoda_stand_in import CyodaStandIn, sample_record
+
+# Measures entity-create throughput, page-drain rate, search round-trip latency and config transfer time,
+# either against an in-process stand-in server or against a real environment, and writes the results as JSON
+# so that runs can be compared before and after a change.
+#
+# How to run it
+# python cyoda_benchmark.py --records 20000 --latency 0.005 --output before.json
+# python cyoda_benchmark.py --host https://dev.cyoda.com/api --username demo.user --records 1000
+
+BENCHMARK_MODEL = "benchmark"
+BENCHMARK_MODEL_VERSION = 1
+PASSWORD_ENV_VALUE = "CYODA_BENCHMARK_PASSWD"
+
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else 0.0
+
+
+def latency_summary(samples):
+    ordered = sorted(samples)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": ordered[-1],
+    }
+
+
+def prepare_model(session):
+    # reset_model reports on stdout, which is reserved for the JSON results
+    with contextlib.redirect_stdout(sys.stderr):
+        session.reset_model(BENCHMARK_MODEL, BENCHMARK_MODEL_VERSION, write_sample_file(), wipe=WIPE_ALWAYS)
+
+
+def write_sample_file():
+    file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    with file:
+        json.dump(sample_record(0), file)
+    return file.name
+
+
+def bench_entity_create(session, args):
+    records = [sample_record(index) for index in range(args.records)]
+
+    start = time.perf_counter()
+    for record in records[:args.single_records]:
+        session.create_entity(BENCHMARK_MODEL, BENCHMARK_MODEL_VERSION, json.dumps(record))
+    single_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = session.create_entities(BENCHMARK_MODEL, BENCHMARK_MODEL_VERSION, records,
+                                     batch_size=args.batch_size, max_in_flight=args.max_in_flight)
+    bulk_seconds = time.perf_counter() - start
+    if not result.ok:
+        raise RuntimeError(f"Bulk create failed: {result.failures}")
+
+    return {
+        "single": {"records": args.single_records, "seconds": single_seconds,
+                   "records_per_second": rate(args.single_records, single_seconds)},
+        "bulk": {"records": args.records, "seconds": bulk_seconds,
+                 "records_per_second": rate(args.records, bulk_seconds),
+                 "batch_size": args.batch_size, "max_in_flight": args.max_in_flight},
+    }
+
+
+def bench_page_drain(session, args):
+    results = {}
+
+    start = time.perf_counter()
+    count = sum(1 for _ in session.iter_entities(BENCHMARK_MODEL, BENCHMARK_MODEL_VERSION, args.page_size))
+    seconds = time.perf_counter() - start
+    results["iter_entities"] = {"records": count, "seconds": seconds, "records_per_second": rate(count, seconds)}
+
+    condition = match_all_condition()
+    status_response = session.search_entities(BENCHMARK_MODEL, BENCHMARK_MODEL_VERSION, condition)
+    snapshot_id = status_response["snapshotId"]
+    entities_count = status_response.get("entitiesCount", 0)
+
+    start = time.perf_counter()
+    count = sum(1 for _ in session.iter_search_results(snapshot_id, args.page_size))
+    seconds = time.perf_counter() - start
+    results["iter_search_results"] = {"records": count, "seconds": seconds,
+                                      "records_per_second": rate(count, seconds)}
+
+    start = time.perf_counter()
+    count = sum(1 for _ in session.read_search_results(snapshot_id, args.page_size, entities_count, args.parallelism))
+    seconds = time.perf_counter() - start
+    results["read_search_results"] = {"records": count, "seconds": seconds,
+                                      "records_per_second": rate(count, seconds), "parallelism": args.parallelism}
+    return results
+
+
+def bench_search_latency(session, args):
+    samples = []
+    for index in range(args.searches):
+        condition = {
+            "type": "group",
+            "operator": "AND",
+            "conditions": [
+                {"type": "simple", "jsonPath": "$.category", "operatorType": "EQUALS",
+                 "value": sample_record(index)["category"]}
+            ]
+        }
+        start = time.perf_counter()
+        session.search_entities(BENCHMARK_MODEL, BENCHMARK_MODEL_VERSION, condition)
+        samples.append(time.perf_counter() - start)
+    return latency_summary(samples)
+
+
+def bench_config_transfer(api_url, args):
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        for mode in ["export", "import"]:
+            command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "cyoda_config_ctl.py"),
+                       "-m", mode, "-u", args.username, "-pw", os.environ[PASSWORD_ENV_VALUE],
+                       "-host", api_url, "-fd", folder, "--workers", str(args.config_workers)]
+            start = time.perf_counter()
+            completed = subprocess.run(command, capture_output=True, text=True)
+            seconds = time.perf_counter() - start
+            if completed.returncode != 0:
+                raise RuntimeError(f"Config {mode} failed: {completed.stdout}{completed.stderr}")
+            results[mode] = {"seconds": seconds, "workers": args.config_workers}
+    return results
+
+
+def match_all_condition():
+    return {
+        "type": "group",
+        "operator": "AND",
+        "conditions": []
+    }
+
+
+def run_benchmarks(api_url, args):
+    results = {}
+    with CyodaSession(api_url, args.username, password_env_value=PASSWORD_ENV_VALUE) as session:
+        prepare_model(session)
+        benchmarks = [
+            ("entity_create", lambda: bench_entity_create(session, args)),
+            ("page_drain", lambda: bench_page_drain(session, args)),
+            ("search_latency", lambda: bench_search_latency(session, args)),
+            ("config_transfer", lambda: bench_config_transfer(api_url, args)),
+        ]
+        for name, benchmark in benchmarks:
+            if args.only and name not in args.only:
+                continue
+            print(f"running {name}", file=sys.stderr)
+            results[name] = benchmark()
+    return results
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Throughput and latency benchmarks for the Cyoda tools')
+    parser.add_argument('-host', '--host', type=str, required=False,
+                        help="benchmark this environment instead of a local stand-in server")
+    parser.add_argument('-u', '--username', type=str, required=False, default="benchmark.user")
+    parser.add_argument('-pw', '--password', type=str, required=False, default="benchmark")
+    parser.add_argument('--output', type=str, required=False, help="write the JSON results to this file")
+    parser.add_argument('--only', type=str, required=False, nargs='+',
+                        choices=["entity_create", "page_drain", "search_latency", "config_transfer"])
+
+    parser.add_argument('--records', type=int, required=False, default=10000)
+    parser.add_argument('--single_records', type=int, required=False, default=200,
+                        help="records created one request at a time as the baseline")
+    parser.add_argument('--batch_size', type=int, required=False, default=1000)
+    parser.add_argument('--max_in_flight', type=int, required=False, default=4)
+    parser.add_argument('--page_size', type=int, required=False, default=1000)
+    parser.add_argument('--parallelism', type=int, required=False, default=4)
+    parser.add_argument('--searches', type=int, required=False, default=20)
+    parser.add_argument('--config_workers', type=int, required=False, default=6)
+
+    parser.add_argument('--latency', type=float, required=False, default=0.0,
+                        help="stand-in only: seconds added to every request")
+    parser.add_argument('--error_rate', type=float, required=False, default=0.0,
+                        help="stand-in only: fraction of requests answered with 503")
+    parser.add_argument('--search_latency', type=float, required=False, default=0.0,
+                        help="stand-in only: seconds a snapshot search stays RUNNING")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    os.environ[PASSWORD_ENV_VALUE] = args.password
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "target": args.host or "stand-in",
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("password", "output")},
+    }
+    if args.host:
+        report["results"] = run_benchmarks(args.host, args)
+    else:
+        with CyodaStandIn(latency=args.latency, error_rate=args.error_rate,
+                          search_latency=args.search_latency) as stand_in:
+            report["results"] = run_benchmarks(stand_in.api_url, args)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    print(output)
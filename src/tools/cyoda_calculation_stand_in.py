@@ -0,0 +1,296 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import argparse
+import asyncio
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import JsonBackend
+from CalculationMember import (
+    ACK_RESPONSE,
+    CRITERIA_REQUEST,
+    CRITERIA_RESPONSE,
+    GREET_EVENT,
+    JOIN_EVENT,
+    KEEP_ALIVE_EVENT,
+    PROCESSOR_REQUEST,
+    PROCESSOR_RESPONSE,
+    CalculationMember,
+    _require_grpc,
+    decode_cloud_event,
+    encode_cloud_event,
+    grpc,
+)
+from CyodaSession import CyodaSession
+from cyoda_benchmark import latency_summary, rate
+from cyoda_stand_in import CyodaStandIn, sample_record
+
+# Local stand-in for the CloudEventsService.startStreaming side of Cyoda, to measure how many calculations a
+# CalculationMember gets through. Once a member has joined it is greeted and sent the configured number of processor
+# and criteria requests, with a keep-alive every keep_alive_interval however busy the member is, and every response
+# is timed. A member that keeps reading its stream acks every keep-alive, which results() reports as acks.
+#
+# How to run it, against a member with built-in sample processors, printing the results as JSON
+# python cyoda_calculation_stand_in.py --requests 20000 --executor process --work 2000
+# python cyoda_calculation_stand_in.py --requests 20000 --executor async --work 0.01 --max_in_flight 500
+
+STAND_IN_SOURCE = "CyodaCalculationStandIn"
+PASSWORD_ENV_VALUE = "CYODA_CALCULATION_STAND_IN_PASSWD"
+
+_CLOSE = object()
+
+
+class CalculationStandIn:
+    def __init__(
+            self,
+            host="127.0.0.1",
+            port=0,
+            processor_requests=1000,
+            criteria_requests=0,
+            processor_name="sample_processor",
+            criteria_name="sample_criteria",
+            keep_alive_interval=1.0,
+            workers=8
+    ):
+        _require_grpc()
+        self.processor_requests = processor_requests
+        self.criteria_requests = criteria_requests
+        self.processor_name = processor_name
+        self.criteria_name = criteria_name
+        self.keep_alive_interval = keep_alive_interval
+
+        self.done = threading.Event()
+        self.responses = 0
+        self.errors = 0
+        self.acks = 0
+        self.keep_alives = 0
+        self.latencies = []
+        self.first_sent = None
+        self.last_received = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+        handler = grpc.method_handlers_generic_handler("org.cyoda.cloud.api.grpc.CloudEventsService", {
+            "startStreaming": grpc.stream_stream_rpc_method_handler(self.start_streaming)
+        })
+        self.server = grpc.server(ThreadPoolExecutor(max_workers=workers), handlers=(handler,))
+        self.port = self.server.add_insecure_port(f"{host}:{port}")
+        self.host = host
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop(grace=None)
+
+    @property
+    def requests(self):
+        return self.processor_requests + self.criteria_requests
+
+    def results(self):
+        with self._lock:
+            elapsed = (self.last_received or time.monotonic()) - (self.first_sent or time.monotonic())
+            return {
+                "requests": self.requests,
+                "responses": self.responses,
+                "errors": self.errors,
+                "acks": self.acks,
+                "keepAlives": self.keep_alives,
+                "elapsed": elapsed,
+                "calculationsPerSecond": rate(self.responses, elapsed),
+                "latency": latency_summary(self.latencies) if self.latencies else None,
+            }
+
+    def start_streaming(self, request_iterator, context):
+        if not any(key == "authorization" and value.startswith("Bearer ")
+                   for key, value in context.invocation_metadata()):
+            context.abort(grpc.StatusCode.UNAUTHENTICATED, "missing bearer token")
+
+        outgoing = queue.Queue()
+        context.add_callback(lambda: outgoing.put((_CLOSE, None)))
+        threading.Thread(target=self._read, args=(request_iterator, outgoing), daemon=True).start()
+        next_keep_alive = time.monotonic() + self.keep_alive_interval
+        while True:
+            try:
+                message, request_id = outgoing.get(timeout=max(next_keep_alive - time.monotonic(), 0))
+            except queue.Empty:
+                message, request_id = None, None
+            if message is _CLOSE:
+                return
+            if time.monotonic() >= next_keep_alive:
+                next_keep_alive = time.monotonic() + self.keep_alive_interval
+                with self._lock:
+                    self.keep_alives += 1
+                yield self._event(KEEP_ALIVE_EVENT, {"id": str(uuid.uuid4()), "memberId": "-"})
+            if message is None:
+                continue
+            if request_id is not None:
+                now = time.monotonic()
+                with self._lock:
+                    self._pending[request_id] = now
+                    if self.first_sent is None:
+                        self.first_sent = now
+            yield message
+
+    def _read(self, request_iterator, outgoing):
+        try:
+            for message in request_iterator:
+                event = decode_cloud_event(message)
+                if event.type == JOIN_EVENT:
+                    greet = {"id": str(uuid.uuid4()), "memberId": str(uuid.uuid4()), "joinedLegalEntityId": "stand-in"}
+                    outgoing.put((self._event(GREET_EVENT, greet), None))
+                    for request_id, request_type, request in self._calculation_requests():
+                        outgoing.put((self._event(request_type, request), request_id))
+                elif event.type in (PROCESSOR_RESPONSE, CRITERIA_RESPONSE):
+                    self._record_response(event.json())
+                elif event.type == ACK_RESPONSE:
+                    with self._lock:
+                        self.acks += 1
+        except grpc.RpcError:
+            pass
+
+    def _calculation_requests(self):
+        for index in range(self.requests):
+            request_id = str(uuid.uuid4())
+            request = {
+                "id": str(uuid.uuid4()),
+                "requestId": request_id,
+                "entityId": str(uuid.uuid4()),
+                "transactionId": str(uuid.uuid4()),
+                "payload": {"type": "TREE", "data": sample_record(index)},
+            }
+            if index < self.processor_requests:
+                request.update(processorId=str(uuid.uuid4()), processorName=self.processor_name)
+                yield request_id, PROCESSOR_REQUEST, request
+            else:
+                request.update(criteriaId=str(uuid.uuid4()), criteriaName=self.criteria_name)
+                yield request_id, CRITERIA_REQUEST, request
+
+    def _record_response(self, response):
+        now = time.monotonic()
+        with self._lock:
+            sent = self._pending.pop(response.get("requestId"), None)
+            if sent is None:
+                return
+            self.latencies.append(now - sent)
+            self.responses += 1
+            if not response.get("success", True):
+                self.errors += 1
+            self.last_received = now
+            finished = self.responses >= self.requests
+        if finished:
+            self.done.set()
+
+    @staticmethod
+    def _event(event_type, event):
+        return encode_cloud_event(event_type, JsonBackend.dumps(event), source=STAND_IN_SOURCE)
+
+
+# Sample calculations for the throughput run, at module level so that the process pool can pickle them
+
+def cpu_processor(request, rounds):
+    digest = JsonBackend.dumps(request["payload"]["data"])
+    for _ in range(rounds):
+        digest = hashlib.sha256(digest).digest()
+    data = request["payload"]["data"]
+    data["digest"] = digest.hex()
+    return data
+
+
+def io_processor(request, seconds):
+    time.sleep(seconds)
+    return request["payload"]["data"]
+
+
+async def async_processor(request, seconds):
+    await asyncio.sleep(seconds)
+    return request["payload"]["data"]
+
+
+def sample_criteria(request):
+    return bool(request["payload"]["data"].get("year"))
+
+
+def run_member(stand_in, args):
+    if args.executor == "process":
+        processor, cpu_bound = functools.partial(cpu_processor, rounds=int(args.work)), True
+    elif args.executor == "thread":
+        processor, cpu_bound = functools.partial(io_processor, seconds=args.work), False
+    else:
+        async def processor(request):
+            return await async_processor(request, args.work)
+        cpu_bound = False
+
+    # The stand-in Cyoda API only serves the member's login
+    with CyodaStandIn() as api, contextlib.redirect_stdout(sys.stderr):
+        session = CyodaSession(api.api_url, username="calculation.user", password_env_value=PASSWORD_ENV_VALUE)
+        member = CalculationMember(session, stand_in.host, stand_in.port, use_tls=False,
+                                   max_in_flight=args.max_in_flight, max_pending=args.max_pending,
+                                   process_workers=args.process_workers,
+                                   thread_workers=args.thread_workers)
+        member.add_processor(stand_in.processor_name, processor, cpu_bound=cpu_bound)
+        member.add_criteria(stand_in.criteria_name, sample_criteria)
+        with member:
+            finished = stand_in.done.wait(args.timeout)
+        if not finished:
+            print(f"Timed out after {args.timeout}s")
+        return member.stats
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Throughput of a calculation member against a local gRPC stand-in')
+    parser.add_argument('--requests', type=int, required=False, default=10000,
+                        help="processor requests sent to the member")
+    parser.add_argument('--criteria_requests', type=int, required=False, default=0)
+    parser.add_argument('--executor', type=str, required=False, default="process",
+                        choices=["process", "thread", "async"],
+                        help="process: sha256 rounds on the process pool, thread: blocking sleep, async: asyncio sleep")
+    parser.add_argument('--work', type=float, required=False, default=1000,
+                        help="sha256 rounds for process, seconds for thread and async")
+    parser.add_argument('--max_in_flight', type=int, required=False, default=64)
+    parser.add_argument('--max_pending', type=int, required=False, default=None,
+                        help="requests the member queues for a free slot, max_in_flight by default")
+    parser.add_argument('--process_workers', type=int, required=False, default=None)
+    parser.add_argument('--thread_workers', type=int, required=False, default=16)
+    parser.add_argument('--keep_alive_interval', type=float, required=False, default=1.0)
+    parser.add_argument('--timeout', type=float, required=False, default=600)
+    parser.add_argument('--output', type=str, required=False, help="write the JSON results to this file")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    os.environ[PASSWORD_ENV_VALUE] = "stand-in"
+
+    with CalculationStandIn(processor_requests=args.requests, criteria_requests=args.criteria_requests,
+                            keep_alive_interval=args.keep_alive_interval) as stand_in:
+        member_stats = run_member(stand_in, args)
+        report = {
+            "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+            "results": stand_in.results(),
+            "member": member_stats,
+        }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    print(output)
@@ -1,14 +1,40 @@
 
 
 import argparse
+import hashlib
 import os
 import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 from enum import Enum
 
 import requests
 import json
+from requests.adapters import HTTPAdapter
+
+from TokenManager import DEFAULT_TOKEN_CACHE_PATH, TokenCache, TokenManager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 RESPONSE_ = "response="
+DEFAULT_WORKERS = 6
+DEFAULT_TARGET_WORKERS = 4
+# Steps and targets report from worker threads, whose print calls would otherwise interleave mid-line
+OUTPUT_LOCK = threading.Lock()
+MANIFEST_FILE = "manifest.json"
+CHUNK_SIZE = 1024 * 1024
+COMPRESSION_SUFFIXES = {
+    "none": "",
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
 
 
 # Script for export/import cyoda configs
@@ -21,20 +47,149 @@ RESPONSE_ = "response="
 # if you prefer input password manually. just enter it in input after command
 # python3 backup_configs.py --mode <export/import> --host "https://my-env.cyoda.net/api" --username your_username --password "your_pass"  --folder_for_save_export_configs "/home/alex/Downloads/test"
 
+# to promote configs from one environment to several others, export once and import into every host of a targets
+# file at the same time. The targets file is a JSON list of hosts, or of objects like
+# {"host": "https://eu.cyoda.net/api", "username": "...", "passwordFile": "..." or "passwordEnv": "..."}
+# whose missing credentials are taken from the command line. --mode import --targets_file ... imports a folder instead
+# python3 cyoda_config_ctl.py --mode promote --host "https://staging.cyoda.net/api" --username your_username --passwordFile /tmp/pass.txt --folder_for_save_export_configs /tmp/configs --targets_file /tmp/targets.json
+
+class ConfigTransferError(Exception):
+    pass
+
+
+class ConfigSet:
+    def __init__(self, name, export_endpoint, import_endpoint, file_name, import_after=()):
+        self.name = name
+        self.export_endpoint = export_endpoint
+        self.import_endpoint = import_endpoint
+        self.file_name = file_name
+        # config sets that must be imported before this one, because it refers to them
+        self.import_after = import_after
+
+    def need_to_export(self):
+        return getattr(args, "need_to_export_" + self.name)
+
+    def need_to_import(self):
+        return getattr(args, "need_to_import_" + self.name)
+
+
+CONFIG_SETS = [
+    ConfigSet(
+        name="distributed_reporting",
+        export_endpoint="/platform-api/reporting/export-all",
+        import_endpoint="/platform-api/reporting/import",
+        file_name="distributed_reporting.json",
+        import_after=("alias_catalog",)
+    ),
+    ConfigSet(
+        name="stream_data",
+        export_endpoint="/platform-api/stream-data/export-all",
+        import_endpoint="/platform-api/stream-data/import",
+        file_name="stream_data.json",
+        import_after=("distributed_reporting",)
+    ),
+    ConfigSet(
+        name="alias_catalog",
+        export_endpoint="/platform-api/catalog/item/export-all",
+        import_endpoint="/platform-api/catalog/item/import?needRewrite=true",
+        file_name="alias_catalog.json"
+    ),
+    ConfigSet(
+        name="composite_indexes",
+        export_endpoint="/platform-common/composite-indexes/export-all",
+        import_endpoint="/platform-common/composite-indexes/import",
+        file_name="composite_indexes.json"
+    ),
+    ConfigSet(
+        name="state_machine",
+        export_endpoint="/platform-api/statemachine/export?includeIds=",
+        import_endpoint="/platform-api/statemachine/import?needRewrite=true",
+        file_name="statemachine.json"
+    ),
+    ConfigSet(
+        name="cobi",
+        export_endpoint="/data-source-config/export-all-cobi",
+        import_endpoint="/data-source-config/import-cobi-config?doPostProcess=true",
+        file_name="cobi.json",
+        import_after=("alias_catalog",)
+    ),
+]
+
+
 class Mode(Enum):
     EXPORT = 'export'
     IMPORT = 'import'
+    PROMOTE = 'promote'
 
     def __str__(self):
         return self.value
 
 
-def login(password_value):
-    url = args.host + "/auth/login"
+class Target:
+    # One Cyoda environment with its own credentials, access token and pool of connections
+    def __init__(self, host, username, password, prefix=""):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.prefix = prefix
+        self.auth_headers = {}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=args.workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def log(self, message):
+        log(self.prefix + message)
+
+    def login(self):
+        # With a token cache, a refresh token from an earlier run is exchanged for an access token
+        # and the password login only happens when there is none or it has expired
+        token_manager = TokenManager(
+            login=lambda: request_login(self),
+            fetch_access_token=lambda refresh_token: request_access_token(self, refresh_token),
+            cache=TokenCache(args.token_cache) if args.token_cache else None,
+            cache_key=self.username + "@" + self.host
+        )
+        self.auth_headers = {"Authorization": "Bearer " + token_manager.get_access_token()}
+
+
+class ConfigSource:
+    # The configs saved in the folder. When they are imported into several targets, each file is hashed for
+    # --incremental or --diff once, but streamed from disk for every target: the files can be too large to hold
+    # in memory for the whole run, and the repeated reads are served by the OS page cache.
+    def __init__(self):
+        self.manifest = load_manifest()
+        self._hashes = {}
+        self._locks = {config_set.name: threading.Lock() for config_set in CONFIG_SETS}
+
+    def content_hash(self, config_set):
+        with self._locks[config_set.name]:
+            if config_set.name not in self._hashes:
+                self._hashes[config_set.name] = local_content_hash(config_set, self.manifest)
+            return self._hashes[config_set.name]
+
+    @contextmanager
+    def payload(self, config_set):
+        # Yields the file path, the data to send and its headers
+        file_path, compression = resolve_config_file(config_set.file_name)
+        headers = {"Content-Type": "application/json; charset=utf-8"}
+        if compression == "gzip" and args.send_compressed:
+            headers["Content-Encoding"] = "gzip"
+        with open(file_path, "rb") as file:
+            yield file_path, payload_data(file, compression), headers
+
+
+def log(message):
+    with OUTPUT_LOCK:
+        print(message, flush=True)
+
+
+def request_login(target):
+    url = target.host + "/auth/login"
 
     data = {
-        "username": args.username,
-        "password": password_value,
+        "username": target.username,
+        "password": target.password,
     }
 
     headers = {
@@ -42,161 +197,283 @@ def login(password_value):
         "Content-Type": "application/json; charset=utf-8",
         "X-Requested-With": "XMLHttpRequest",
     }
-    response = requests.post(url, data=json.dumps(data), headers=headers)
+    response = target.session.post(url, data=json.dumps(data), headers=headers)
 
     if response.status_code != 200:
-        print("invalid username or password. response code=" + str(response.status_code))
-        print(RESPONSE_ + str(response.text))
-        sys.exit(1)
+        raise ConfigTransferError("invalid username or password. response code=" + str(response.status_code)
+                                  + "\n" + RESPONSE_ + str(response.text))
 
     parsed_response = response.json()
 
     if "token" in parsed_response:
-        return parsed_response["token"]
+        return parsed_response.get("refreshToken"), parsed_response["token"]
     else:
-        print("can not find token in response=" + parsed_response)
-        sys.exit(1)
+        raise ConfigTransferError("can not find token in response=" + str(parsed_response))
 
 
-def abstract_export_data(is_need_export, endpoint, output_json):
-    if not is_need_export:
-        print("skipping export " + endpoint)
-        return
+def request_access_token(target, refresh_token):
+    url = target.host + "/auth/token"
 
-    url = args.host + endpoint
-
-    response = requests.get(url, headers=auth_headers)
+    response = target.session.get(url, headers={"Authorization": "Bearer " + refresh_token})
 
     if response.status_code != 200:
-        print("can not export " + endpoint)
-        print(RESPONSE_ + str(response.text))
-        sys.exit(1)
+        raise requests.HTTPError("can not refresh token. response code=" + str(response.status_code))
 
-    file_path = args.folder_for_save_export_configs + "/" + output_json
-    json_data = response.json()
-
-    file = open(file_path, "w")
-    file.write(json.dumps(json_data))
-    file.close()
-    print("saved " + file_path)
+    return response.json().get("token")
 
 
-def abstract_import_data(is_need_import, endpoint, file_name):
-    if not is_need_import:
-        print("skipping import " + endpoint)
+def abstract_export_data(target, is_need_export, endpoint, output_json):
+    if not is_need_export:
+        target.log("skipping export " + endpoint)
         return
 
-    url = args.host + endpoint
-    file_path = args.folder_for_save_export_configs + "/" + file_name
-    file = open(file_path, "r")
-    data = file.read()
-    file.close()
-    headers = {"Content-Type": "application/json; charset=utf-8"}
+    url = target.host + endpoint
 
-    response = requests.post(url, data=data, headers={**auth_headers, **headers})
-
-    if response.status_code != 200:
-        print("can not import " + file_name)
-        print(RESPONSE_ + str(response.text))
-        sys.exit(1)
-    else:
-        print("imported " + file_path)
-
-
-def export_distributed_reporting():
-    abstract_export_data(
-        is_need_export=args.need_to_export_stream_data,
-        endpoint="/platform-api/reporting/export-all",
-        output_json="distributed_reporting.json"
-    )
-
-
-def export_stream_data():
-    abstract_export_data(
-        is_need_export=args.need_to_export_stream_data,
-        endpoint="/platform-api/stream-data/export-all",
-        output_json="stream_data.json"
-    )
+    with target.session.get(url, headers=target.auth_headers, stream=True) as response:
+        if response.status_code != 200:
+            raise ConfigTransferError("can not export " + endpoint + "\n" + RESPONSE_ + str(response.text))
 
+        file_path = os.path.join(args.folder_for_save_export_configs, output_json + COMPRESSION_SUFFIXES[args.compression])
+        checksum = write_atomically(response.iter_content(CHUNK_SIZE), file_path, args.compression)
 
-def export_alias_catalog():
-    abstract_export_data(
-        is_need_export=args.need_to_export_alias_catalog,
-        endpoint="/platform-api/catalog/item/export-all",
-        output_json="alias_catalog.json"
-    )
+    write_atomically([(checksum + "  " + os.path.basename(file_path) + "\n").encode()], file_path + ".sha256")
+    remove_stale_exports(output_json, file_path)
+    target.log("saved " + file_path + " sha256=" + checksum)
+    return file_path
 
 
-def export_composite_indexes():
-    abstract_export_data(
-        is_need_export=args.need_to_export_composite_indexes,
-        endpoint="/platform-common/composite-indexes/export-all",
-        output_json="composite_indexes.json"
-    )
+def remove_stale_exports(file_name, file_path):
+    # An earlier export with another compression would otherwise be imported instead of this one
+    for suffix in COMPRESSION_SUFFIXES.values():
+        stale_path = os.path.join(args.folder_for_save_export_configs, file_name + suffix)
+        if stale_path == file_path:
+            continue
+        for path in (stale_path, stale_path + ".sha256"):
+            if os.path.exists(path):
+                os.unlink(path)
 
 
-def export_statemachine():
-    abstract_export_data(
-        is_need_export=args.need_to_export_state_machine,
-        endpoint="/platform-api/statemachine/export?includeIds=",
-        output_json="statemachine.json"
-    )
+def abstract_import_data(target, source, is_need_import, config_set):
+    endpoint = config_set.import_endpoint
+    if not is_need_import:
+        target.log("skipping import " + endpoint)
+        return
 
+    url = target.host + endpoint
 
-def export_cobi():
-    abstract_export_data(
-        is_need_export=args.need_to_export_cobi,
-        endpoint="/data-source-config/export-all-cobi",
-        output_json="cobi.json"
-    )
+    with source.payload(config_set) as (file_path, data, headers):
+        response = target.session.post(url, data=data, headers={**target.auth_headers, **headers})
 
-
-def import_distributed_reporting():
-    abstract_import_data(
-        is_need_import=args.need_to_import_distributed_reporting,
-        endpoint="/platform-api/reporting/import",
-        file_name="distributed_reporting.json"
-    )
+    if response.status_code != 200:
+        raise ConfigTransferError("can not import " + config_set.file_name + "\n" + RESPONSE_ + str(response.text))
+    else:
+        target.log("imported " + file_path)
+
+
+def payload_data(file, compression):
+    # The file is sent as it is unless it has to be decompressed first
+    if compression == "none" or (compression == "gzip" and args.send_compressed):
+        return file
+    return iter_decompressed(file, compression)
+
+
+def write_atomically(chunks, file_path, compression="none"):
+    # Streams the chunks through the compressor into a temp file next to the target and renames it
+    # into place, so a failed transfer never leaves a truncated file behind. Returns the sha256 of
+    # the bytes written.
+    compressor = create_compressor(compression)
+    checksum = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or ".", prefix="." + os.path.basename(file_path))
+    try:
+        with os.fdopen(fd, "wb") as file:
+            def write(data):
+                if data:
+                    checksum.update(data)
+                    file.write(data)
+
+            for chunk in chunks:
+                write(compressor.compress(chunk) if compressor else chunk)
+            if compressor:
+                write(compressor.flush())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return checksum.hexdigest()
+
+
+def create_compressor(compression):
+    if compression == "gzip":
+        return zlib.compressobj(wbits=31)
+    if compression == "zstd":
+        return require_zstandard().ZstdCompressor().compressobj()
+    return None
+
+
+def iter_decompressed(file, compression):
+    if compression == "gzip":
+        decompressor = zlib.decompressobj(wbits=31)
+    else:
+        decompressor = require_zstandard().ZstdDecompressor().decompressobj()
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if compression == "gzip":
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise ConfigTransferError("zstd compression needs the zstandard package, install it with pip install zstandard")
+    return zstandard
+
+
+def iter_file(file_path, compression):
+    with open(file_path, "rb") as file:
+        if compression == "none":
+            yield from iter(lambda: file.read(CHUNK_SIZE), b"")
+        else:
+            yield from iter_decompressed(file, compression)
+
+
+def content_hash(chunks):
+    # Hash of the normalised JSON (sorted keys, no whitespace), so that two configs compare equal
+    # regardless of formatting or key order
+    data = json.loads(b"".join(chunks))
+    normalised = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(normalised.encode()).hexdigest()
+
+
+def load_manifest():
+    try:
+        with open(os.path.join(args.folder_for_save_export_configs, MANIFEST_FILE), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(entries):
+    manifest = load_manifest()
+    manifest.update(entries)
+    file_path = os.path.join(args.folder_for_save_export_configs, MANIFEST_FILE)
+    write_atomically([json.dumps(manifest, indent=2, sort_keys=True).encode()], file_path)
+    print("saved " + file_path)
 
 
-def import_stream_data():
-    abstract_import_data(
-        is_need_import=args.need_to_import_stream_data,
-        endpoint="/platform-api/stream-data/import",
-        file_name="stream_data.json"
-    )
+def manifest_entry(file_path, compression):
+    stat = os.stat(file_path)
+    return {
+        "file": os.path.basename(file_path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": content_hash(iter_file(file_path, compression)),
+    }
 
 
-def import_alias_catalog():
-    abstract_import_data(
-        is_need_import=args.need_to_import_alias_catalog,
-        endpoint="/platform-api/catalog/item/import?needRewrite=true",
-        file_name="alias_catalog.json"
+def local_content_hash(config_set, manifest):
+    # The manifest hash is trusted as long as the file has not been touched since it was recorded
+    file_path, compression = resolve_config_file(config_set.file_name)
+    entry = manifest.get(config_set.name)
+    stat = os.stat(file_path)
+    if entry and entry.get("file") == os.path.basename(file_path) \
+            and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+        return entry["sha256"]
+    return content_hash(iter_file(file_path, compression))
+
+
+def remote_content_hash(target, config_set):
+    url = target.host + config_set.export_endpoint
+    with target.session.get(url, headers=target.auth_headers, stream=True) as response:
+        if response.status_code != 200:
+            return None
+        return content_hash(response.iter_content(CHUNK_SIZE))
+
+
+def resolve_config_file(file_name):
+    # Imports accept a config file saved with any of the supported compressions. When a folder holds
+    # more than one, e.g. from before exports removed their siblings, the most recently written one wins.
+    candidates = []
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        file_path = os.path.join(args.folder_for_save_export_configs, file_name + suffix)
+        if os.path.exists(file_path):
+            candidates.append((os.stat(file_path).st_mtime, file_path, compression))
+    if not candidates:
+        raise ConfigTransferError("can not find " + file_name + " in " + args.folder_for_save_export_configs)
+    _, file_path, compression = max(candidates)
+    return file_path, compression
+
+
+def export_config_set(target, config_set, manifest_entries):
+    file_path = abstract_export_data(
+        target,
+        is_need_export=config_set.need_to_export(),
+        endpoint=config_set.export_endpoint,
+        output_json=config_set.file_name
     )
+    if file_path is not None:
+        manifest_entries[config_set.name] = manifest_entry(file_path, args.compression)
 
 
-def import_composite_indexes():
-    abstract_import_data(
-        is_need_import=args.need_to_import_composite_indexes,
-        endpoint="/platform-common/composite-indexes/import",
-        file_name="composite_indexes.json"
-    )
-
+def import_config_set(target, source, config_set):
+    if config_set.need_to_import() and (args.incremental or args.diff):
+        if source.content_hash(config_set) == remote_content_hash(target, config_set):
+            target.log("unchanged " + config_set.name)
+            return
+        if args.diff:
+            target.log("would import " + config_set.name)
+            return
 
-def import_statemachine():
     abstract_import_data(
-        is_need_import=args.need_to_import_state_machine,
-        endpoint="/platform-api/statemachine/import?needRewrite=true",
-        file_name="statemachine.json"
+        target,
+        source,
+        is_need_import=config_set.need_to_import(),
+        config_set=config_set
     )
 
 
-def import_cobi():
-    abstract_import_data(
-        is_need_import=args.need_to_import_cobi,
-        endpoint="/data-source-config/import-cobi-config?doPostProcess=true",
-        file_name="cobi.json"
-    )
+def run_steps(steps, workers):
+    # steps maps a step name to (function, names of the steps it depends on). Every step whose
+    # dependencies have finished runs at once on the worker pool, so the total time is that of the
+    # slowest chain instead of the sum of all steps.
+    timings = {}
+    failed = {}
+    pending = dict(steps)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name, (function, depends_on) in list(pending.items()):
+                if any(dependency in failed for dependency in depends_on):
+                    del pending[name]
+                    failed[name] = ConfigTransferError("skipped because a step it depends on failed")
+                elif all(dependency in timings for dependency in depends_on if dependency in steps):
+                    del pending[name]
+                    running[executor.submit(function)] = (name, time.monotonic())
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, started = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    timings[name] = time.monotonic() - started
+                else:
+                    failed[name] = error
+
+    return timings, failed
+
+
+def print_step_timings(names, timings, failed):
+    for name in names:
+        if name in timings:
+            print(f"  {name:<24} {timings[name]:8.2f}s")
+        elif name in failed:
+            print(f"  {name:<24}   FAILED  {failed[name]}")
 
 
 def get_folder_root():
@@ -206,8 +483,30 @@ def get_folder_root():
     return folder
 
 
-def get_auth_headers():
-    return {"Authorization": "Bearer " + token}
+def read_password_file(password_file):
+    return open(password_file, "r").readline().rstrip()
+
+
+def load_targets(password):
+    # Each target may bring its own username and passwordFile or passwordEnv, the command line ones are the default
+    with open(args.targets_file, "r") as file:
+        entries = json.load(file)
+
+    targets = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"host": entry}
+        target_password = password
+        if entry.get("passwordFile"):
+            target_password = read_password_file(entry["passwordFile"])
+        elif entry.get("passwordEnv"):
+            target_password = os.environ.get(entry["passwordEnv"])
+            if target_password is None:
+                raise ConfigTransferError("environment variable " + entry["passwordEnv"] + " for " + entry["host"]
+                                          + " is not set")
+        targets.append(Target(entry["host"], entry.get("username", args.username), target_password,
+                              prefix="[" + entry["host"] + "] "))
+    return targets
 
 
 def check_python_version():
@@ -228,8 +527,26 @@ def parse_arguments():
     parser.add_argument('-pf', '--passwordFile', type=str, required=False, help='file with password for login to Cyoda')
     parser.add_argument('-pw', '--password', type=str, required=False, help='the password to log into Cyoda, if you do not have a password file')
 
-    parser.add_argument('-host', '--host', type=str, required=True, help="host like https://dev.cyoda.com/api")
+    parser.add_argument('-host', '--host', type=str, required=False,
+                        help="host like https://dev.cyoda.com/api, the source of a promote")
     parser.add_argument('-fd', '--folder_for_save_export_configs', type=str, required=True)
+    parser.add_argument('--token_cache', type=str, required=False, nargs='?', const=DEFAULT_TOKEN_CACHE_PATH,
+                        help='cache the refresh token in this file (default ' + DEFAULT_TOKEN_CACHE_PATH + ') to skip the login on later runs')
+
+    parser.add_argument('--compression', type=str, required=False, default="none", choices=list(COMPRESSION_SUFFIXES),
+                        help='compress exported configs on the fly')
+    parser.add_argument('--send_compressed', action='store_true',
+                        help='upload gzip configs as they are with Content-Encoding: gzip instead of decompressing them')
+    parser.add_argument('--incremental', action='store_true',
+                        help='import only the config sets whose content differs from the target')
+    parser.add_argument('--diff', action='store_true',
+                        help='only report which config sets an import would change')
+    parser.add_argument('--workers', type=int, required=False, default=DEFAULT_WORKERS,
+                        help='number of config sets transferred in parallel')
+    parser.add_argument('--targets_file', type=str, required=False,
+                        help='JSON file with the hosts to import into at the same time, for import and promote')
+    parser.add_argument('--target_workers', type=int, required=False, default=DEFAULT_TARGET_WORKERS,
+                        help='number of targets imported into in parallel')
 
     parser.add_argument('--need_to_export_distributed_reporting', type=bool, required=False, default=True)
     parser.add_argument('--need_to_export_stream_data', type=bool, required=False, default=True)
@@ -245,29 +562,84 @@ def parse_arguments():
     parser.add_argument('--need_to_import_state_machine', type=bool, required=False, default=False)
     parser.add_argument('--need_to_import_cobi', type=bool, required=False, default=True)
 
-    return parser.parse_args()
+    parsed_args = parser.parse_args()
+    if parsed_args.mode == Mode.PROMOTE and not parsed_args.targets_file:
+        parser.error("--mode promote needs --targets_file")
+    if parsed_args.mode == Mode.EXPORT and parsed_args.targets_file:
+        parser.error("--targets_file is for import and promote")
+    if not parsed_args.host and not (parsed_args.mode == Mode.IMPORT and parsed_args.targets_file):
+        parser.error("--host is required")
+    return parsed_args
+
+
+def start_export(target):
+    manifest_entries = {}
+    steps = {config_set.name: (lambda c=config_set: export_config_set(target, c, manifest_entries), ())
+             for config_set in CONFIG_SETS}
+    timings, failed = run_steps(steps, args.workers)
+    print_step_timings(steps, timings, failed)
+    save_manifest(manifest_entries)
+    if failed:
+        sys.exit(1)
+
+    print("finish export configs")
 
 
-def start_export():
-    export_distributed_reporting()
-    export_stream_data()
-    export_alias_catalog()
-    export_composite_indexes()
-    export_statemachine()
-    export_cobi()
+def import_steps(target, source):
+    return {config_set.name: (lambda c=config_set: import_config_set(target, source, c), config_set.import_after)
+            for config_set in CONFIG_SETS}
 
-    print("finish export configs")
 
+def start_imports(target):
+    steps = import_steps(target, source=ConfigSource())
+    timings, failed = run_steps(steps, args.workers)
+    print_step_timings(steps, timings, failed)
+    if failed:
+        sys.exit(1)
 
-def start_imports():
-    import_distributed_reporting()
-    import_stream_data()
-    import_alias_catalog()
-    import_composite_indexes()
-    import_statemachine()
-    import_cobi()
+    if args.diff:
+        print("finish diff configs")
+    else:
+        print("finish import configs")
+
+
+def import_into(target, source):
+    # Login and import of one target; its errors end up in its summary and never reach the other targets
+    started = time.monotonic()
+    try:
+        target.login()
+    except Exception as e:
+        return time.monotonic() - started, {}, {"login": e}
+    timings = {"login": time.monotonic() - started}
+
+    step_timings, failed = run_steps(import_steps(target, source), args.workers)
+    timings.update(step_timings)
+    return time.monotonic() - started, timings, failed
+
+
+def start_fan_out(targets):
+    # Imports the folder into every target at once, at most args.target_workers targets at a time, each over its
+    # own pool of args.workers connections
+    source = ConfigSource()
+    with ThreadPoolExecutor(max_workers=args.target_workers) as executor:
+        results = [(target, executor.submit(import_into, target, source)) for target in targets]
+
+    names = ["login"] + [config_set.name for config_set in CONFIG_SETS]
+    failed_targets = 0
+    print("summary")
+    for target, result in results:
+        elapsed, timings, failed = result.result()
+        failed_targets += bool(failed)
+        print(f"{target.host}  {'FAILED' if failed else 'OK'}  {elapsed:.2f}s")
+        print_step_timings(names, timings, failed)
+    print(f"{len(targets) - failed_targets} of {len(targets)} targets succeeded")
+    if failed_targets:
+        sys.exit(1)
 
-    print("finish import configs")
+    if args.diff:
+        print("finish diff configs")
+    else:
+        print("finish import configs")
 
 
 if __name__ == '__main__':
@@ -279,13 +651,25 @@ if __name__ == '__main__':
     if passwordFile is None:
         password = args.password
     else:
-        password = open(passwordFile, "r").readline().rstrip()
+        password = read_password_file(passwordFile)
 
-    token = login(password)
-    auth_headers = get_auth_headers()
     folder_for_save = get_folder_root()
 
+    try:
+        targets = load_targets(password) if args.targets_file else []
+        if args.mode != Mode.IMPORT or not targets:
+            source_target = Target(args.host, args.username, password)
+            source_target.login()
+    except ConfigTransferError as e:
+        print(e)
+        sys.exit(1)
+
     if args.mode == Mode.EXPORT:
-        start_export()
+        start_export(source_target)
+    elif args.mode == Mode.PROMOTE:
+        start_export(source_target)
+        start_fan_out(targets)
+    elif targets:
+        start_fan_out(targets)
     else:
-        start_imports()
+        start_imports(source_target)
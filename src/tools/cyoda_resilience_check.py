@@ -0,0 +1,94 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import argparse
+import os
+import sys
+import time
+
+import requests
+
+from CyodaSession import CyodaSession
+from Resilience import CircuitBreaker, CircuitOpenError, Resilience
+from cyoda_stand_in import FIRST_PAGE_NUMBER, CyodaStandIn
+
+# Replays an outage against an in-process stand-in and checks that CyodaSession's circuit breaker recovers:
+# 503s open the breaker, a 429 answering the half-open trial must not leave it stuck, and the first call after
+# the server recovers must close it even when the access token expired during the outage and has to be refreshed.
+# Exits with status 1 when a step does not behave as expected.
+#
+# How to run it
+# python cyoda_resilience_check.py
+
+CHECK_MODEL = "prize"
+CHECK_MODEL_VERSION = 1
+PASSWORD_ENV_VALUE = "CYODA_RESILIENCE_CHECK_PASSWD"
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def call(session):
+    # Returns the outcome of one guarded call: "ok", the HTTP status it failed with, or "fast-fail"
+    try:
+        session.get_all_entities(CHECK_MODEL, CHECK_MODEL_VERSION, 10, FIRST_PAGE_NUMBER)
+        return "ok"
+    except CircuitOpenError:
+        return "fast-fail"
+    except requests.HTTPError as e:
+        return str(e).split(": ", 1)[1].split(" ", 1)[0]
+
+
+def expect(step, actual, expected, breaker, state):
+    print(f"{step}: {actual}, breaker {breaker.state}")
+    if actual != expected or breaker.state != state:
+        raise CheckFailed(f"{step}: expected {expected} with the breaker {state}, "
+                          f"got {actual} with the breaker {breaker.state}")
+
+
+def run_check(reset_timeout):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=reset_timeout)
+    resilience = Resilience(max_retries=0, circuit_breaker=breaker)
+    with CyodaStandIn(dataset_size=10, dataset_model=CHECK_MODEL, dataset_version=CHECK_MODEL_VERSION) as stand_in:
+        session = CyodaSession(stand_in.api_url, username="resilience.user", password_env_value=PASSWORD_ENV_VALUE,
+                               resilience=resilience)
+        try:
+            expect("healthy", call(session), "ok", breaker, CircuitBreaker.CLOSED)
+
+            stand_in.config.error_rate = 1.0
+            stand_in.config.error_status = 503
+            expect("first 503", call(session), "503", breaker, CircuitBreaker.CLOSED)
+            expect("second 503", call(session), "503", breaker, CircuitBreaker.OPEN)
+            expect("while open", call(session), "fast-fail", breaker, CircuitBreaker.OPEN)
+
+            time.sleep(reset_timeout)
+            stand_in.config.error_status = 429
+            expect("429 on the trial", call(session), "429", breaker, CircuitBreaker.HALF_OPEN)
+
+            # The server recovers while the access token has expired, so the next trial refreshes it first
+            stand_in.config.error_rate = 0.0
+            session.token_manager.invalidate(session.token_manager.get_access_token())
+            expect("trial with an expired token", call(session), "ok", breaker, CircuitBreaker.CLOSED)
+            expect("recovered", call(session), "ok", breaker, CircuitBreaker.CLOSED)
+        finally:
+            session.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Checks that the circuit breaker recovers after an outage')
+    parser.add_argument('--reset_timeout', type=float, required=False, default=0.2,
+                        help="seconds the breaker stays open before its half-open trial")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    os.environ[PASSWORD_ENV_VALUE] = "stand-in"
+    try:
+        run_check(args.reset_timeout)
+    except CheckFailed as e:
+        print(f"FAILED {e}")
+        sys.exit(1)
+    print("OK")
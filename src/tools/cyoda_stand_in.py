@@ -0,0 +1,528 @@
+#  Copyright (c) 2024 Cyoda Limited. All rights reserved.
+#  This software is the confidential and proprietary information of Cyoda Limited ("Confidential Information").
+#  Unauthorized use, disclosure, distribution, or reproduction is prohibited. Any use or access to this software
+#  is subject to the terms of the applicable agreements and prior written consent from Cyoda Limited.
+import argparse
+import base64
+import gzip
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Local stand-in for the parts of the Cyoda API used by CyodaSession and cyoda_config_ctl, so that
+# performance changes can be measured without a live environment. Everything is kept in memory.
+#
+# How to run it
+# python cyoda_stand_in.py --port 8082 --latency 0.02 --error_rate 0.01 --dataset_size 100000
+# then point the tools at http://localhost:8082/api
+
+# Pages are numbered like CyodaSession's default, see FIRST_PAGE_NUMBER there
+FIRST_PAGE_NUMBER = 1
+API_PREFIX = "/api"
+SNAPSHOT_TTL = timedelta(hours=1)
+CONFIG_EXPORTS = {
+    "/platform-api/reporting/export-all": "distributed_reporting",
+    "/platform-api/stream-data/export-all": "stream_data",
+    "/platform-api/catalog/item/export-all": "alias_catalog",
+    "/platform-common/composite-indexes/export-all": "composite_indexes",
+    "/platform-api/statemachine/export": "state_machine",
+    "/data-source-config/export-all-cobi": "cobi",
+}
+CONFIG_IMPORTS = {
+    "/platform-api/reporting/import": "distributed_reporting",
+    "/platform-api/stream-data/import": "stream_data",
+    "/platform-api/catalog/item/import": "alias_catalog",
+    "/platform-common/composite-indexes/import": "composite_indexes",
+    "/platform-api/statemachine/import": "state_machine",
+    "/data-source-config/import-cobi-config": "cobi",
+}
+
+
+def make_token(lifetime):
+    # Unsigned JWT shaped token, only the expiry claim matters to the clients
+    def encode(part):
+        return base64.urlsafe_b64encode(json.dumps(part).encode()).decode().rstrip("=")
+
+    return ".".join([encode({"alg": "none"}), encode({"exp": int(time.time() + lifetime), "jti": uuid.uuid4().hex}), ""])
+
+
+def sample_record(index):
+    return {
+        "year": str(1901 + index % 120),
+        "category": ["physics", "chemistry", "medicine", "literature", "peace", "economics"][index % 6],
+        "laureates": [
+            {"id": str(index), "firstname": f"First{index}", "surname": f"Surname{index}", "share": "1"}
+        ]
+    }
+
+
+def simple_view(sample):
+    # Describes the structure of a sample the way the SIMPLE_VIEW export does: one node per object path
+    # mapping each field to its type
+    nodes = {}
+
+    def visit(path, value):
+        node = nodes.setdefault(path, {})
+        if isinstance(value, dict):
+            for key, child in value.items():
+                node["." + key] = type_name(child)
+                if isinstance(child, (dict, list)):
+                    visit(path + "." + key, child)
+        elif isinstance(value, list):
+            for child in value:
+                node["[*]"] = type_name(child)
+                if isinstance(child, (dict, list)):
+                    visit(path + "[*]", child)
+
+    visit("$", sample)
+    return nodes
+
+
+def merge_views(view, other):
+    for path, fields in other.items():
+        node = view.setdefault(path, {})
+        for key, types in fields.items():
+            known = node.get(key)
+            if known is None or known == types:
+                node[key] = types
+            else:
+                merged = set(known if isinstance(known, list) else [known])
+                merged.update(types if isinstance(types, list) else [types])
+                node[key] = sorted(merged)
+
+
+def type_name(value):
+    if isinstance(value, bool):
+        return "BOOLEAN"
+    if isinstance(value, int):
+        return "INTEGER"
+    if isinstance(value, float):
+        return "DOUBLE"
+    if isinstance(value, str):
+        return "STRING"
+    if isinstance(value, list):
+        return "ARRAY_ELEMENT"
+    if isinstance(value, dict):
+        return "OBJECT"
+    return "NULL"
+
+
+def json_path_values(document, json_path):
+    values = [document]
+    for token in re.finditer(r"\.([^.\[]+)|(\[\*\])", json_path[1:]):
+        key, wildcard = token.groups()
+        next_values = []
+        for value in values:
+            if wildcard and isinstance(value, list):
+                next_values.extend(value)
+            elif key and isinstance(value, dict) and key in value:
+                next_values.append(value[key])
+        values = next_values
+    return values
+
+
+def matches(document, condition):
+    if condition.get("type") == "group":
+        results = (matches(document, child) for child in condition.get("conditions", []))
+        return all(results) if condition.get("operator", "AND") == "AND" else any(results)
+
+    values = json_path_values(document, condition["jsonPath"])
+    expected = condition.get("value")
+    operator = condition.get("operatorType", "EQUALS")
+    if operator == "EQUALS":
+        return any(str(value) == str(expected) for value in values)
+    if operator == "NOT_EQUAL":
+        return all(str(value) != str(expected) for value in values)
+    if operator == "CONTAINS":
+        return any(str(expected) in str(value) for value in values)
+    return False
+
+
+class StandInState:
+    def __init__(self, dataset_size=0, dataset_model="prize", dataset_version=1, search_latency=0.0,
+                 first_page_number=FIRST_PAGE_NUMBER):
+        self.lock = threading.Lock()
+        self.search_latency = search_latency
+        self.first_page_number = first_page_number
+        self.models = {}
+        self.entities = {}
+        self.entity_models = {}
+        self.snapshots = {}
+        self.configs = {name: json.dumps([]).encode() for name in CONFIG_EXPORTS.values()}
+
+        if dataset_size:
+            key = (dataset_model, str(dataset_version))
+            self.models[key] = {"state": "LOCKED", "id": str(uuid.uuid4()), "version": 1,
+                                "model": simple_view(sample_record(0))}
+            entities = self.entities.setdefault(key, OrderedDict())
+            for index in range(dataset_size):
+                entity_id = str(uuid.uuid4())
+                entities[entity_id] = sample_record(index)
+                self.entity_models[entity_id] = key
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "CyodaStandIn/1.0"
+    # Headers and body are written separately, without this small responses wait on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        config = self.server.config
+        if config.latency:
+            time.sleep(config.latency)
+
+        url = urlsplit(self.path)
+        path = url.path[len(API_PREFIX):] if url.path.startswith(API_PREFIX) else url.path
+        params = {key: values[0] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+        body = self.read_body()
+
+        if config.error_rate and not path.startswith("/auth/") and random.random() < config.error_rate:
+            return self.respond(config.error_status, {"error": "injected failure"}, headers={"Retry-After": "0"})
+
+        for route_method, pattern, handler in ROUTES:
+            if route_method == method:
+                match = re.fullmatch(pattern, path)
+                if match:
+                    return handler(self, params, body, *match.groups())
+        self.respond(404, {"error": f"no stand-in route for {method} {path}"})
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b"".join(chunks)
+        else:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+        if self.headers.get("Content-Encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def respond(self, status, payload=None, headers=None, raw=None):
+        data = raw if raw is not None else (b"" if payload is None else json.dumps(payload).encode())
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    @property
+    def state(self):
+        return self.server.state
+
+    # auth
+
+    def login(self, params, body):
+        self.respond(200, {"token": make_token(300), "refreshToken": make_token(86400)})
+
+    def token(self, params, body):
+        self.respond(200, {"token": make_token(300)})
+
+    # models
+
+    def export_model(self, params, body, model_name, model_version):
+        with self.state.lock:
+            model = self.state.models.get((model_name, model_version))
+        if model is None:
+            return self.respond(404, {"error": f"model {model_name} {model_version} not found"})
+        etag = f'"{model["id"]}-{model["version"]}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self.respond(304, headers={"ETag": etag})
+        self.respond(200, {"currentState": model["state"], "model": model["model"]}, headers={"ETag": etag})
+
+    def import_model(self, params, body, model_name, model_version):
+        sample_view = simple_view(json.loads(body))
+        with self.state.lock:
+            model = self.state.models.get((model_name, model_version))
+            if model is None:
+                model = {"state": "UNLOCKED", "id": str(uuid.uuid4()), "version": 1, "model": sample_view}
+                self.state.models[(model_name, model_version)] = model
+            elif model["state"] == "LOCKED":
+                return self.respond(409, {"error": "model is locked"})
+            else:
+                # Further samples extend an unlocked model
+                merge_views(model["model"], sample_view)
+                model["version"] += 1
+        self.respond(200, raw=model["id"].encode())
+
+    def lock_model(self, params, body, model_name, model_version, action):
+        with self.state.lock:
+            model = self.state.models.get((model_name, model_version))
+            if model is None:
+                return self.respond(404, {"error": "model not found"})
+            if action == "unlock" and self.state.entities.get((model_name, model_version)):
+                return self.respond(409, {"error": "model has entities"})
+            model["state"] = "LOCKED" if action == "lock" else "UNLOCKED"
+            model["version"] += 1
+        self.respond(200)
+
+    def delete_model(self, params, body, model_name, model_version):
+        with self.state.lock:
+            if self.state.entities.get((model_name, model_version)):
+                return self.respond(409, {"error": "model has entities"})
+            if self.state.models.pop((model_name, model_version), None) is None:
+                return self.respond(404, {"error": "model not found"})
+        self.respond(200)
+
+    # entities
+
+    def create_entities(self, params, body, model_name, model_version):
+        key = (model_name, model_version)
+        documents = json.loads(body)
+        if not isinstance(documents, list):
+            documents = [documents]
+        with self.state.lock:
+            model = self.state.models.get(key)
+            if model is None or model["state"] != "LOCKED":
+                return self.respond(400, {"error": "model must exist and be locked"})
+            entities = self.state.entities.setdefault(key, OrderedDict())
+            entity_ids = []
+            for document in documents:
+                entity_id = str(uuid.uuid4())
+                entities[entity_id] = document
+                self.state.entity_models[entity_id] = key
+                entity_ids.append(entity_id)
+        self.respond(200, [{"transactionId": str(uuid.uuid4()), "entityIds": entity_ids}])
+
+    def get_entities(self, params, body, model_name, model_version):
+        page_size = int(params.get("pageSize", 1000))
+        page_number = int(params.get("pageNumber", self.state.first_page_number))
+        with self.state.lock:
+            entities = self.state.entities.get((model_name, model_version), OrderedDict())
+            start = page_size * (page_number - self.state.first_page_number)
+            page = [self.envelope(entity_id, entities[entity_id])
+                    for entity_id in list(entities)[start:start + page_size]] if start >= 0 else []
+        self.respond(200, page)
+
+    def delete_entities(self, params, body, model_name, model_version):
+        transaction_size = int(params.get("transactionSize", 1000))
+        condition = json.loads(body) if body else None
+        with self.state.lock:
+            if condition is None:
+                entities = self.state.entities.pop((model_name, model_version), OrderedDict())
+            else:
+                model_entities = self.state.entities.get((model_name, model_version), OrderedDict())
+                entities = [entity_id for entity_id, document in model_entities.items()
+                            if matches(document, condition)]
+                for entity_id in entities:
+                    del model_entities[entity_id]
+            for entity_id in entities:
+                self.state.entity_models.pop(entity_id, None)
+        removed = len(entities)
+        results = []
+        while removed > 0 or not results:
+            count = min(removed, transaction_size)
+            results.append({"deleteResult": {"numberOfEntititesRemoved": count}})
+            removed -= count
+        self.respond(200, results)
+
+    def delete_entity(self, params, body, entity_id):
+        with self.state.lock:
+            key = self.state.entity_models.pop(entity_id, None)
+            if key is None:
+                return self.respond(404, {"error": f"entity {entity_id} not found"})
+            del self.state.entities[key][entity_id]
+        self.respond(200, {"id": entity_id})
+
+    @staticmethod
+    def envelope(entity_id, document):
+        return {"meta": {"id": entity_id, "state": "VALID"}, "data": document}
+
+    # snapshot search
+
+    def create_snapshot(self, params, body, model_name, model_version):
+        condition = json.loads(body)
+        with self.state.lock:
+            entities = self.state.entities.get((model_name, model_version), OrderedDict())
+            entity_ids = [entity_id for entity_id, document in entities.items() if matches(document, condition)]
+            snapshot_id = str(uuid.uuid4())
+            self.state.snapshots[snapshot_id] = {
+                "entityIds": entity_ids,
+                "readyAt": time.monotonic() + self.state.search_latency,
+                "expirationDate": (datetime.now(timezone.utc) + SNAPSHOT_TTL).isoformat(),
+            }
+        self.respond(200, snapshot_id)
+
+    def snapshot_status(self, params, body, snapshot_id):
+        with self.state.lock:
+            snapshot = self.state.snapshots.get(snapshot_id)
+        if snapshot is None:
+            return self.respond(404, {"error": f"snapshot {snapshot_id} not found"})
+        ready = time.monotonic() >= snapshot["readyAt"]
+        found = len(snapshot["entityIds"])
+        self.respond(200, {
+            "snapshotStatus": "SUCCESSFUL" if ready else "RUNNING",
+            "entitiesCount": found if ready else found // 2,
+            "expirationDate": snapshot["expirationDate"],
+        })
+
+    def snapshot_page(self, params, body, snapshot_id):
+        page_size = int(params.get("pageSize", 1000))
+        page_number = int(params.get("pageNumber", self.state.first_page_number))
+        with self.state.lock:
+            snapshot = self.state.snapshots.get(snapshot_id)
+            if snapshot is None:
+                return self.respond(404, {"error": f"snapshot {snapshot_id} not found"})
+            start = page_size * (page_number - self.state.first_page_number)
+            page = []
+            for entity_id in snapshot["entityIds"][start:start + page_size] if start >= 0 else []:
+                key = self.state.entity_models.get(entity_id)
+                if key is not None:
+                    page.append(self.envelope(entity_id, self.state.entities[key][entity_id]))
+        self.respond(200, page)
+
+    # configs
+
+    def export_config(self, params, body, endpoint):
+        with self.state.lock:
+            data = self.state.configs[CONFIG_EXPORTS[endpoint]]
+        self.respond(200, raw=data)
+
+    def import_config(self, params, body, endpoint):
+        json.loads(body)
+        with self.state.lock:
+            self.state.configs[CONFIG_IMPORTS[endpoint]] = body
+        self.respond(200, {"success": True})
+
+
+def _alternatives(endpoints):
+    return "(" + "|".join(re.escape(endpoint) for endpoint in endpoints) + ")"
+
+
+ROUTES = [
+    ("POST", r"/auth/login", StandInHandler.login),
+    ("GET", r"/auth/token", StandInHandler.token),
+    ("GET", r"/treeNode/model/export/SIMPLE_VIEW/([^/]+)/([^/]+)", StandInHandler.export_model),
+    ("POST", r"/treeNode/model/import/JSON/SAMPLE_DATA/([^/]+)/([^/]+)", StandInHandler.import_model),
+    ("PUT", r"/treeNode/model/([^/]+)/([^/]+)/(lock|unlock)", StandInHandler.lock_model),
+    ("DELETE", r"/treeNode/model/([^/]+)/([^/]+)", StandInHandler.delete_model),
+    ("POST", r"/entity/JSON/TREE/([^/]+)/([^/]+)", StandInHandler.create_entities),
+    ("GET", r"/entity/TREE/([^/]+)/([^/]+)", StandInHandler.get_entities),
+    ("DELETE", r"/entity/TREE/([^/]+)/([^/]+)", StandInHandler.delete_entities),
+    ("DELETE", r"/entity/TREE/([^/]+)", StandInHandler.delete_entity),
+    ("GET", r"/treeNode/search/snapshot/([^/]+)/status", StandInHandler.snapshot_status),
+    ("POST", r"/treeNode/search/snapshot/([^/]+)/([^/]+)", StandInHandler.create_snapshot),
+    ("GET", r"/treeNode/search/snapshot/([^/]+)", StandInHandler.snapshot_page),
+    ("GET", _alternatives(CONFIG_EXPORTS), StandInHandler.export_config),
+    ("POST", _alternatives(CONFIG_IMPORTS), StandInHandler.import_config),
+]
+
+
+class StandInConfig:
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=503):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+
+class CyodaStandIn:
+    def __init__(
+            self,
+            host="127.0.0.1",
+            port=0,
+            latency=0.0,
+            error_rate=0.0,
+            search_latency=0.0,
+            dataset_size=0,
+            dataset_model="prize",
+            dataset_version=1,
+            first_page_number=FIRST_PAGE_NUMBER,
+            error_status=503
+    ):
+        self.server = ThreadingHTTPServer((host, port), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.config = StandInConfig(latency, error_rate, error_status)
+        self.server.state = StandInState(dataset_size, dataset_model, dataset_version, search_latency,
+                                         first_page_number)
+        self._thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{API_PREFIX}"
+
+    @property
+    def config(self):
+        return self.server.config
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Cyoda API')
+    parser.add_argument('--host', type=str, required=False, default="127.0.0.1")
+    parser.add_argument('--port', type=int, required=False, default=8082)
+    parser.add_argument('--latency', type=float, required=False, default=0.0, help="seconds added to every request")
+    parser.add_argument('--error_rate', type=float, required=False, default=0.0,
+                        help="fraction of requests answered with error_status")
+    parser.add_argument('--error_status', type=int, required=False, default=503, choices=[429, 503],
+                        help="status of the injected failures")
+    parser.add_argument('--search_latency', type=float, required=False, default=0.0,
+                        help="seconds a snapshot search stays RUNNING")
+    parser.add_argument('--dataset_size', type=int, required=False, default=0,
+                        help="number of entities preloaded into the dataset model")
+    parser.add_argument('--dataset_model', type=str, required=False, default="prize")
+    parser.add_argument('--dataset_version', type=int, required=False, default=1)
+    parser.add_argument('--first_page_number', type=int, required=False, default=FIRST_PAGE_NUMBER,
+                        help="number of the first page of entity and snapshot results")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    stand_in = CyodaStandIn(args.host, args.port, args.latency, args.error_rate, args.search_latency,
+                            args.dataset_size, args.dataset_model, args.dataset_version, args.first_page_number,
+                            args.error_status)
+    print("serving the Cyoda stand-in on " + stand_in.api_url)
+    try:
+        stand_in.server.serve_forever()
+    except KeyboardInterrupt:
+        stand_in.server.server_close()